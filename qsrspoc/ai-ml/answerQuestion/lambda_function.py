@@ -1,30 +1,28 @@
 import boto3
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 s3 = boto3.client('s3')
 
-# Get utils
-def get_bucket() -> str:
-    for possible_bucket in [
-        'qsrs-ocr-poc-dev',
-        'ahrq-qsrs-ml-poc'
-    ]:
-        x = boto3.resource('s3').Bucket(possible_bucket)
-        if x.creation_date is not None:
-            return possible_bucket
-    return None
-import sys
-sys.path.append('/tmp')
-s3.download_file(get_bucket(), 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
 
 # Get config file
 CONFIG = utils.get_config()
 
 def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils, CONFIG
+    utils = bootstrap.load_utils()
+    CONFIG = utils.get_config()
     # EVENT: called to answer a question from the LLM
     print(event)
 
+    # Batch mode: answer a whole algorithm's prompts (or a subset) in one invocation
+    if 'prompts' in event:
+        return answer_questions_batch(event)
+
     # Step 1: Access the payload sent from initiating Lambda
     prompt, pretty_prompt = get_prompt_from_event(event)
 
@@ -32,27 +30,88 @@ def lambda_handler(event, context):
     all_page_text_file = event['all_page_text_file']
     all_page_text = utils.load_s3_json(folder=CONFIG['cleaned-data-folder'], file=all_page_text_file, bucket=CONFIG['bucket'], json_key=None)
     embeddings_key = event['embeddings_key']
-    embeddings = utils.load_s3_json(key=embeddings_key, bucket=CONFIG['bucket'], json_key=None)
+    similarity_engine = utils.load_similarity_engine(embeddings_key, bucket=CONFIG['bucket'])
             
     # Step 1.5 -- splice out just question from prompt artifacts?
     # Prompt artifacts: "Answer in MM/DD/YYYY format" or "Choose from one of these options: Yes/No/Can't tell"
     question = prompt.split('|')[0]
 
-    # Step 2: Vector-embed the question and compute cosine similarities
-    question_embeddings_1d = utils.query_embeddings_endpoint(question) # may replace with "question" if doing step 3.5
-    similarities = {pagenum: utils.cosine_similarity(question_embeddings_1d, page_embedding) for pagenum, page_embedding in embeddings.items()}
+    # Step 2: Vector-embed the question
+    question_embeddings_1d = utils.embed_questions([question])[0] # may replace with "question" if doing step 3.5
+
+    # Steps 3-5: Compute similarities, query the LLM and parse its response
+    use_cache = not bypass_llm_cache(event)
+    output = answer_prompt(prompt, pretty_prompt, question_embeddings_1d, similarity_engine, all_page_text, use_cache=use_cache)
+    print_llm_cache_stats()
+
+    return json.dumps(output)
+
+
+def answer_questions_batch(event):
+    """
+    Answers many prompts against one document, loading the document artifacts once.
+
+    Event keys: "prompts" (dict of prompt key -> prompt, e.g. the assignVars output),
+    optional "questions" (list of prompt keys to answer, default all), "all_page_text_file",
+    "embeddings_key", optional "config_questions_key" for list-replace prompts and optional
+    "bypass_llm_cache" to force fresh LLM responses for this run.
+
+    Returns a JSON string of {prompt key: {Question, Answer, Reason, Pages used, Confidence score}}.
+    """
+    prompts = event['prompts']
+    prompt_keys = event.get('questions') or list(prompts.keys())
+
+    # Step 1: Load the document's text and page embeddings once for every question
+    all_page_text = utils.load_s3_json(folder=CONFIG['cleaned-data-folder'], file=event['all_page_text_file'], bucket=CONFIG['bucket'], json_key=None)
+    similarity_engine = utils.load_similarity_engine(event['embeddings_key'], bucket=CONFIG['bucket'])
+
+    # Step 1.5: Resolve list-replace prompts, keyed the same way the step functions pass "qnum"
+    resolved = {}
+    for qnum in prompt_keys:
+        if event.get('config_questions_key'):
+            resolved[qnum] = handle_list_replace_prompt({**event, 'qnum': qnum}, prompts[qnum])
+        else:
+            resolved[qnum] = prompts[qnum], prompts[qnum]
+
+    # Step 2: Embed all questions in one pass
+    questions = [prompt.split('|')[0] for prompt, pretty_prompt in resolved.values()]
+    question_embeddings = utils.embed_questions(questions)
+    embeddings_by_qnum = dict(zip(resolved.keys(), question_embeddings))
+
+    # Steps 3-5: Answer with bounded concurrency, keeping the prompt order in the output
+    use_cache = not bypass_llm_cache(event)
+    def answer(qnum):
+        prompt, pretty_prompt = resolved[qnum]
+        return answer_prompt(prompt, pretty_prompt, embeddings_by_qnum[qnum], similarity_engine, all_page_text, use_cache=use_cache)
+
+    max_workers = max(1, min(int(CONFIG.get('answer-batch-concurrency', 4)), len(resolved)))
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        answers = list(pool.map(answer, resolved.keys()))
+
+    output = dict(zip(resolved.keys(), answers))
+    print_llm_cache_stats()
+    return json.dumps(output)
+
+
+def answer_prompt(prompt, pretty_prompt, question_embeddings_1d, similarity_engine, all_page_text, use_cache=True):
+    # Step 3: Compute cosine similarities against every page
+    similarities = similarity_engine.similarities(question_embeddings_1d, k=CONFIG.get('similarity-top-k', 10))
 
-    # Step 3: Construct prompt minus context
+    # Step 3.5: Construct prompt minus context
     prompt_minus_context = utils.construct_prompt_minus_context(prompt)
 
-    # Step 4: Recursively query LLM with fewer pages of context until we are under the token limit
-    answer_plus_reason, pages_used, confidence_score = utils.query_llm(
+    # Step 4: Query LLM with as many of the best pages as fit the prompt token budget
+    answer_plus_reason, pages_used, confidence_score, prompt_tokens = utils.query_llm(
         prompt_minus_context=prompt_minus_context,
         similarities_dict=similarities,
         all_page_text=all_page_text,
-        context_replace=CONFIG['context-replace']
+        context_replace=CONFIG['context-replace'],
+        first_page=similarity_engine.first_page,
+        use_cache=use_cache
     )
 
+    print(f'Prompt tokens used for "{pretty_prompt}": {prompt_tokens}')
+
     # Step 5: Split answer & reason, store in output
     answer, reason = utils.parse_answer_and_reason(answer_plus_reason)
     output = {
@@ -62,8 +121,19 @@ def lambda_handler(event, context):
         'Pages used': pages_used,
         'Confidence score': confidence_score
     }
+    return output
 
-    return json.dumps(output)
+
+def bypass_llm_cache(event):
+    # Set per run by startAlgorithms and passed through the step functions; config is the fallback
+    return bool(event.get('bypass_llm_cache', CONFIG.get('llm-response-cache-bypass', False)))
+
+
+def print_llm_cache_stats():
+    # Hit/miss counters accumulate for the life of the container
+    cache = utils.get_llm_response_cache()
+    if cache is not None:
+        print(f'LLM response cache: {cache.stats()}')
 
 
 def get_prompt_from_event(event):
@@ -3,22 +3,14 @@ import boto3
 
 s3 = boto3.client('s3')
 
-# Get utils
-def get_bucket() -> str:
-    for possible_bucket in [
-        'qsrs-ocr-poc-dev',
-        'ahrq-qsrs-ml-poc'
-    ]:
-        x = boto3.resource('s3').Bucket(possible_bucket)
-        if x.creation_date is not None:
-            return possible_bucket
-    return None
-import sys
-sys.path.append('/tmp')
-s3.download_file(get_bucket(), 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
 
 def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils
+    utils = bootstrap.load_utils()
     # EVENT: page-embeddings folder is added to - 1
     # (actually triggered via Step function, but passing along the pathing information)
 
@@ -48,4 +40,5 @@ def lambda_handler(event, context):
         'all_page_text_file': all_page_text_file,
         'prompts': prompts,
         'passed_data': passed_data,
+        'bypass_llm_cache': bool(event.get('bypass_llm_cache', False)),
     }
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""
+Compares the page embeddings of the int8 / ONNX inference backends against the fp32 PyTorch
+baseline on a sample corpus, and reports cosine drift and CPU throughput per backend.
+
+The corpus is one or more cleaned-data files ({"Page 1": "text", ...}), given as local paths,
+directories of such files, or s3://bucket/key URIs.
+
+Usage:
+    python compare_backends.py <model_dir> <corpus> [<corpus> ...] [--backends int8 onnx]
+        [--max-pages 200] [--threshold 0.99] [--report drift_report.json]
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+
+import inference
+
+def load_corpus(sources, max_pages=None):
+    # Returns a flat list of non-blank page texts
+    pages = []
+    for source in sources:
+        if source.startswith('s3://'):
+            import boto3
+
+            bucket, key = source[len('s3://'):].split('/', 1)
+            body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+            documents = [json.loads(body)]
+        elif os.path.isdir(source):
+            documents = []
+            for file in sorted(os.listdir(source)):
+                if file.endswith('.json'):
+                    with open(os.path.join(source, file)) as f:
+                        documents.append(json.load(f))
+        else:
+            with open(source) as f:
+                documents = [json.load(f)]
+
+        for document in documents:
+            pages.extend(text for text in document.values() if isinstance(text, str) and text.strip())
+
+    return pages[:max_pages] if max_pages else pages
+
+def embed_corpus(model_and_tokenizer, pages, request_size=16):
+    # Runs predict_fn the way the endpoint would, request_size pages per request
+    start = time.perf_counter()
+    embeddings = []
+    for i in range(0, len(pages), request_size):
+        embeddings.extend(inference.predict_fn(pages[i:i + request_size], model_and_tokenizer)['embeddings'])
+    return torch.tensor(embeddings), time.perf_counter() - start
+
+def drift_stats(baseline, candidate, threshold):
+    cosine = torch.nn.functional.cosine_similarity(baseline, candidate, dim=1)
+    return {
+        'cosine_mean': round(cosine.mean().item(), 6),
+        'cosine_min': round(cosine.min().item(), 6),
+        'cosine_p5': round(torch.quantile(cosine, 0.05).item(), 6),
+        f'pages_below_{threshold}': int((cosine < threshold).sum().item()),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Cosine drift of BioBERT inference backends vs fp32')
+    parser.add_argument('model_dir')
+    parser.add_argument('corpus', nargs='+')
+    parser.add_argument('--backends', nargs='+', default=['int8', 'onnx'])
+    parser.add_argument('--max-pages', type=int, default=200)
+    parser.add_argument('--threshold', type=float, default=0.99)
+    parser.add_argument('--request-size', type=int, default=16)
+    parser.add_argument('--report', help='Write the report as JSON to this path')
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus, max_pages=args.max_pages)
+    print(f'{len(pages)} pages, {torch.get_num_threads()} CPU threads')
+
+    baseline, baseline_seconds = embed_corpus(inference.load_backend(args.model_dir, 'pytorch'), pages, args.request_size)
+    report = {
+        'pages': len(pages),
+        'threads': torch.get_num_threads(),
+        'pytorch': {'seconds': round(baseline_seconds, 3), 'pages_per_second': round(len(pages) / baseline_seconds, 3)},
+    }
+
+    for backend in args.backends:
+        candidate, seconds = embed_corpus(inference.load_backend(args.model_dir, backend), pages, args.request_size)
+        report[backend] = {
+            'seconds': round(seconds, 3),
+            'pages_per_second': round(len(pages) / seconds, 3),
+            'speedup': round(baseline_seconds / seconds, 2),
+            **drift_stats(baseline, candidate, args.threshold),
+        }
+
+    print(json.dumps(report, indent=4))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,81 @@
 from transformers import AutoModel, AutoTokenizer
+from transformers.modeling_outputs import BaseModelOutput
 import torch
 import json
 import os
 
+# Chunks per forward pass; override with the INFERENCE_BATCH_SIZE model environment variable
+DEFAULT_BATCH_SIZE = 16
+# Model window (incl. [CLS]/[SEP]) and the number of tokens consecutive windows share
+MAX_TOKENS = 512
+CHUNK_STRIDE = 50
+# Inference backend, set with the INFERENCE_BACKEND model environment variable:
+# "pytorch" (fp32 eager, default), "int8" (dynamic int8 quantization of the Linear layers)
+# or "onnx" (ONNX Runtime on model.onnx, exported on first load if missing)
+# Set the ai-ml config "embedding-inference-backend" to the endpoint's value: it is part of the embedding
+# model ID, so cached question and page vectors are never reused across backends
+DEFAULT_BACKEND = 'pytorch'
+ONNX_FILENAME = 'model.onnx'
+
+class OnnxEncoder:
+    # Wraps an ONNX Runtime session so predict_fn can call it like the PyTorch model
+    def __init__(self, onnx_path, config):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.config = config
+
+    def __call__(self, **inputs):
+        feeds = {name: inputs[name].numpy() for name in self.input_names if name in inputs}
+        last_hidden_state = self.session.run(['last_hidden_state'], feeds)[0]
+        return BaseModelOutput(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+def export_onnx(model, tokenizer, onnx_path):
+    # Trace the encoder with dynamic batch/sequence axes
+    dummy = tokenizer(['export sample'], return_tensors='pt')
+    # Positional order of BertModel.forward, not the tokenizer's key order
+    input_names = [key for key in ('input_ids', 'attention_mask', 'token_type_ids') if key in dummy]
+    dynamic_axes = {name: {0: 'batch', 1: 'tokens'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'tokens'}
+    torch.onnx.export(
+        model,
+        args=tuple(dummy[name] for name in input_names),
+        f=onnx_path,
+        input_names=input_names,
+        output_names=['last_hidden_state'],
+        dynamic_axes=dynamic_axes,
+        opset_version=14,
+    )
+    return onnx_path
+
+def load_backend(model_dir, backend):
+    model = AutoModel.from_pretrained(model_dir)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    if backend == 'pytorch':
+        return model, tokenizer
+    elif backend == 'int8':
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model, tokenizer
+    elif backend == 'onnx':
+        onnx_path = os.path.join(model_dir, ONNX_FILENAME)
+        if not os.path.exists(onnx_path):
+            # model_dir may be read-only on the endpoint
+            onnx_path = export_onnx(model, tokenizer, os.path.join('/tmp', ONNX_FILENAME))
+        return OnnxEncoder(onnx_path, model.config), tokenizer
+    raise ValueError(f"Unsupported inference backend: {backend}")
+
 def model_fn(model_dir):
     # Load the model from the directory provided by SageMaker
     print(model_dir)
     print(os.listdir(model_dir))
-    model = AutoModel.from_pretrained(model_dir)
-    tokenizer = AutoTokenizer.from_pretrained(model_dir)
-    return model, tokenizer
+    backend = os.environ.get('INFERENCE_BACKEND', DEFAULT_BACKEND)
+    print(f'Inference backend: {backend}')
+    return load_backend(model_dir, backend)
 
 def input_fn(request_body, content_type='application/json'):
     if content_type == 'application/json':
@@ -18,57 +84,119 @@ def input_fn(request_body, content_type='application/json'):
     else:
         raise ValueError(f"Unsupported content type: {content_type}")
 
-def predict_fn(input_data, model_and_tokenizer):
-    model, tokenizer = model_and_tokenizer
-    #print(input_data)
+def get_input_texts(input_data):
+    # "inputs" may be one text (str or {"text": ...}) or a list of them
+    # Returns (texts, is_batch)
+    def as_text(item):
+        if isinstance(item, str):
+            return item
+        elif isinstance(item, dict):
+            return item['text']
+        raise TypeError(f'Unsupported input type: {type(item).__name__}')
 
     try:
-        if isinstance(input_data, str):
-            input_text = input_data
-        elif isinstance(input_data, dict):
-            input_text = input_data['text']
+        if isinstance(input_data, list):
+            return [as_text(item) for item in input_data], True
+        return [as_text(input_data)], False
 
     except Exception as e:
         print(input_data)
-        print('Input is not either str or dict with "text" key')
+        print('Input is not either str, dict with "text" key, or a list of those')
         raise
 
-    # Chunk input text -- if short text, just turns into len-1 list
-    chunks = chunk_text(input_text, tokenizer)
-    if len(chunks) > 1:
-        print(f'Needed to split input text into {len(chunks)} chunks to keep under {512} tokens')
-        print('This may lead to a failure to return properly')
-        for i in range(len(chunks)):
-            print('Chunk', i, 'len', len(tokenizer.tokenize(chunks[i])))
-
-    # Loop over all chunks
-    final_output = [] # shape [n_chunks, n_tokenz, X]
-    for chunk in chunks:
-
-        # Tokenize input text
-        inputs = tokenizer(chunk, return_tensors="pt", padding=True, truncation=True)
-        
+def predict_fn(input_data, model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    #print(input_data)
+    texts, is_batch = get_input_texts(input_data)
+    batch_size = int(os.environ.get('INFERENCE_BATCH_SIZE', DEFAULT_BATCH_SIZE))
+
+    # Split every input text into token windows -- short texts just give one window
+    if tokenizer.is_fast:
+        encoded, owners = chunk_token_ids(texts, tokenizer)
+    else:
+        encoded, owners = chunk_text_windows(texts, tokenizer)
+
+    # Running sums of token embeddings and token counts per input text
+    hidden_size = model.config.hidden_size
+    token_sums = torch.zeros(len(texts), hidden_size)
+    token_counts = torch.zeros(len(texts))
+
+    # Similar-length windows share a mini-batch to keep padding small
+    order = sorted(range(len(owners)), key=lambda i: len(encoded['input_ids'][i]))
+    for start in range(0, len(order), batch_size):
+        batch_idx = order[start:start + batch_size]
+        features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch_idx]
+        inputs = tokenizer.pad(features, padding=True, return_tensors="pt")
+
         # Run the model to get embeddings
         with torch.no_grad():
             outputs = model(**inputs)
 
-        # Return the embeddings as a list and avg to coalesce into 1-D list
-        embeddings = outputs.last_hidden_state[0] # shape: [num_tokens, hidden_size]
+        # Attention-mask-aware sum, so padding tokens do not dilute the average
+        mask = inputs['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype) # shape: [batch, num_tokens, 1]
+        chunk_sums = (outputs.last_hidden_state * mask).sum(dim=1) # shape: [batch, hidden_size]
+        chunk_counts = mask.sum(dim=(1, 2)) # shape: [batch]
 
-        # Append to final output
-        final_output.append(embeddings)
-    
-    # Concatenate e.g. [501, X] + [39, X] --> [540, X]
-    final_output = torch.cat(final_output, dim=0) # shape: [num_tokens_FULLPAGE, X]
+        batch_owners = torch.tensor([owners[i] for i in batch_idx])
+        token_sums.index_add_(0, batch_owners, chunk_sums.float())
+        token_counts.index_add_(0, batch_owners, chunk_counts.float())
 
-    # Take avg and return
-    final_output = final_output.mean(dim=0).tolist() # shape: [X]
-    
-    return {"embeddings": final_output}
+    # Average over every token of every chunk of a text, e.g. [501, X] + [39, X] --> [X]
+    final_output = []
+    for text_idx in range(len(texts)):
+        if token_counts[text_idx] > 0:
+            final_output.append((token_sums[text_idx] / token_counts[text_idx]).tolist()) # shape: [X]
+        else:
+            final_output.append([]) # blank text
+
+    return {"embeddings": final_output if is_batch else final_output[0]}
 
 def output_fn(prediction, accept='application/json'):
     return json.dumps({"predictions": prediction})
 
+def chunk_token_ids(texts, tokenizer, max_length=MAX_TOKENS, stride=CHUNK_STRIDE):
+    """
+    Tokenizes all texts in one call and splits long ones into overlapping windows of token IDs,
+    using the fast tokenizer's overflow support -- no detokenize/re-tokenize round trip, and
+    every window fits the model limit exactly.
+
+    Returns:
+        encoded (dict): model inputs (input_ids, attention_mask, ...) as one list per window.
+        owners (list): index of the input text each window came from.
+    """
+    # Blank texts get no windows (and so an empty embedding), not a lone [CLS][SEP]
+    non_blank = [i for i, text in enumerate(texts) if text.strip()]
+    if not non_blank:
+        return {'input_ids': []}, []
+
+    encoded = tokenizer(
+        [texts[i] for i in non_blank],
+        truncation=True,
+        max_length=max_length,
+        stride=stride,
+        return_overflowing_tokens=True,
+    )
+    owners = [non_blank[i] for i in encoded['overflow_to_sample_mapping']]
+    for text_idx in sorted(set(owners)):
+        n_windows = owners.count(text_idx)
+        if n_windows > 1:
+            print(f'Split input {text_idx} into {n_windows} windows of <= {max_length} tokens')
+
+    model_inputs = [key for key in tokenizer.model_input_names if key in encoded]
+    return {key: encoded[key] for key in model_inputs}, owners
+
+def chunk_text_windows(texts, tokenizer):
+    # Fallback for slow tokenizers: string chunks from chunk_text, tokenized in one call
+    chunks = []
+    owners = []
+    for text_idx, text in enumerate(texts):
+        text_chunks = chunk_text(text, tokenizer)
+        chunks.extend(text_chunks)
+        owners.extend([text_idx] * len(text_chunks))
+    if not chunks:
+        return {'input_ids': []}, []
+    return dict(tokenizer(chunks, truncation=True)), owners
+
 def chunk_text(text, tokenizer, chunk_size=500, overlap=50):
     """
     Splits a long text into overlapping chunks of tokens.
@@ -9,20 +9,9 @@ from time import sleep
 # Initialize S3 client
 s3 = boto3.client('s3')
 
-# Get utils
-def get_bucket() -> str:
-    for possible_bucket in [
-        'qsrs-ocr-poc-dev',
-        'ahrq-qsrs-ml-poc'
-    ]:
-        x = boto3.resource('s3').Bucket(possible_bucket)
-        if x.creation_date is not None:
-            return possible_bucket
-    return None
-import sys
-sys.path.append('/tmp')
-s3.download_file(get_bucket(), 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
 
 # Get config file
 CONFIG = utils.get_config()
@@ -35,12 +24,20 @@ def output_file_from_input(input_bucket: str, input_folder: str, input_file: str
     output_folder = CONFIG['cleaned-data-folder']
 
     # Get output filename -- don't make this too hard
-    output_file = input_file.replace(CONFIG['structured-extension'], CONFIG['cleaned-extension'])
+    structured_extension = CONFIG['structured-extension']
+    if input_file.endswith(CONFIG.get('structured-json-extension', 'structured.json')):
+        structured_extension = CONFIG.get('structured-json-extension', 'structured.json')
+    output_file = input_file.replace(structured_extension, CONFIG['cleaned-extension'])
     output_key = output_folder + output_file
 
     return output_bucket, output_key, output_folder, output_file
 
 def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils, CONFIG, KEEP_KEY_VALUE_TEXT
+    utils = bootstrap.load_utils()
+    CONFIG = utils.get_config()
+    KEEP_KEY_VALUE_TEXT = CONFIG['keep-key-value-text']
     # EVENT: Textract output is structured into single json file, "ocr-results/" folder is added to
     
     # Extract bucket name and object key from the S3 event
@@ -73,10 +70,12 @@ def lambda_handler(event, context):
     }
     
 def clean_data(json_content: dict):
-    # json_content is a dict mapping str(pagenum): page_text
+    # json_content is a dict mapping str(pagenum): page_text (legacy structured text), or
+    # str(pagenum): {"text_lines": [...], "kv": [...], "tables": [...]} (structured json)
     # Iterate through each cleaning function 
     output = json_content.copy()
     output = clean_json_page_keys(output)
+    output = render_json_pages(output)
     output = remove_excessive_whitespace(output)
     output = remove_headers_footers(output)
 
@@ -114,6 +113,31 @@ def clean_json_page_keys(pages: dict) -> dict:
         output[new_pagenum] = page
     return output
 
+# Render structured json pages as the legacy structured text of the same page, so both formats
+# are cleaned (and embedded) identically: text lines joined by ", ", and the same sections
+def render_json_pages(pages: dict) -> dict:
+    output = {}
+    for pagenum, page in pages.items():
+        if isinstance(page, dict):
+            page = render_json_page(pagenum, page)
+        output[pagenum] = page
+    return output
+
+def render_json_page(pagenum: str, page: dict) -> str:
+    # Same layout as build_page_string_withoutsection in the OCR structured output generator
+    text = ', '.join(page.get('text_lines', [])).replace('\\', '/') or f"This page {pagenum} is blank"
+    lines = ['', f"  Text: {text}"]
+    if page.get('kv'):
+        lines.append('  Key-Value Pairs:')
+        lines.extend(f"    {kv['key']}: {kv['value']}".replace('\\', '/') for kv in page['kv'])
+    if page.get('tables'):
+        lines.append('  Tables:')
+        for table_index, table in enumerate(page['tables'], start=1):
+            lines.append(f'    Table {table_index}:')
+            lines.append(f"      Column Header: {', '.join(table.get('column_header', []))}".replace('\\', '/'))
+            lines.extend(f"      Row{row_index}: {', '.join(row)}".replace('\\', '/') for row_index, row in enumerate(table.get('rows', []), start=1))
+    return '\n'.join(lines) + '\n'
+
 # Reduce sections with excessive "\n"
 def remove_excessive_whitespace(pages, num_newlines_mid=3, num_newlines_end=1):
     output = pages.copy()
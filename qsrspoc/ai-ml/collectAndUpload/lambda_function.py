@@ -3,20 +3,9 @@ import boto3
 
 s3 = boto3.client('s3')
 
-# Get utils
-def get_bucket() -> str:
-    for possible_bucket in [
-        'qsrs-ocr-poc-dev',
-        'ahrq-qsrs-ml-poc'
-    ]:
-        x = boto3.resource('s3').Bucket(possible_bucket)
-        if x.creation_date is not None:
-            return possible_bucket
-    return None
-import sys
-sys.path.append('/tmp')
-s3.download_file(get_bucket(), 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
 import logging
 
 logger = logging.getLogger()
@@ -29,6 +18,9 @@ logger.setLevel(logging.INFO)
 # For now, implement HAI-COVID-19
 
 def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils
+    utils = bootstrap.load_utils()
     
     # Step 1: Access payload sent by initiating step function
     page_embeddings_key = event['page-embeddings-file']
@@ -0,0 +1,19 @@
+import json
+from datetime import datetime, timedelta
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
+
+def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils
+    utils = bootstrap.load_utils()
+    # EVENT: daily schedule (EventBridge); optionally {"day": "YYYY-MM-DD", "delete_events": false}
+    day = event.get('day') or (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    result = utils.compact_process_logs(day, delete_events=event.get('delete_events', True))
+    print(f"Compacted {result['events_compacted']} log events into {result['daily_key']}")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(result)
+    }
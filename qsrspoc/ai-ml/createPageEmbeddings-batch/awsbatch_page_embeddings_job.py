@@ -1,24 +1,20 @@
 import json
+import os
 import boto3
-from typing import List
+from typing import List, Tuple
+import sys
 import time
+import importlib.util
 
 s3 = boto3.client('s3')
 
-def get_my_config():
-    response = s3.get_object(Bucket='qsrs-ocr-poc-dev', Key='config/ai-ml/config.json')
-    data = response['Body'].read().decode('utf-8')
-    config = json.loads(data, strict=False)
-    return config
-
-import sys
-sys.path.append('/tmp')
-#Download utils file
-s3.download_file('qsrs-ocr-poc-dev', 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils and config with the same loader as the ai-ml Lambdas (bootstrap.py is copied into the image
+# from ai-ml/layers/bootstrap; the buckets come from QSRS_BUCKET and QSRS_CONFIG_BUCKET)
+import bootstrap
+utils = bootstrap.load_utils()
 
 # Get config file
-CONFIG = get_my_config()
+CONFIG = utils.get_config()
 #Get output file based on the input file
 def output_file_from_input(input_bucket: str, input_folder: str, input_file: str) -> List[str]:
     # Output bucket + folder are easy
@@ -32,6 +28,66 @@ def output_file_from_input(input_bucket: str, input_folder: str, input_file: str
 
     return output_bucket, output_key, output_folder, output_file
 
+LOCAL_MODEL_DIR = '/tmp/biobert-model'
+LOCAL_PAGES_PER_CALL = 32 # predict_fn splits these into INFERENCE_BATCH_SIZE mini-batches
+_local_model = None
+
+def get_container_vcpus() -> int:
+    # CPUs this container may run on (its cpuset), not the host's CPU count
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def download_local_model(bucket: str, prefix: str, local_dir: str = LOCAL_MODEL_DIR) -> str:
+    # Copy the unpacked biobert-model folder (weights, tokenizer files, inference.py) from S3
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            relative_path = obj['Key'][len(prefix):]
+            if not relative_path or relative_path.endswith('/'):
+                continue
+            local_path = os.path.join(local_dir, relative_path)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            s3.download_file(bucket, obj['Key'], local_path)
+    return local_dir
+
+def load_local_model():
+    # Load model_fn/predict_fn from the model's own inference.py, once per job
+    global _local_model
+    if _local_model is None:
+        t1 = time.time()
+        model_dir = download_local_model(utils.BUCKET, CONFIG['batch_local_model_prefix'])
+        inference_path = os.path.join(model_dir, 'inference.py')
+        if not os.path.exists(inference_path):
+            inference_path = os.path.join(model_dir, 'code', 'inference.py')
+        spec = importlib.util.spec_from_file_location('inference', inference_path)
+        inference = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(inference)
+
+        import torch
+        threads = int(CONFIG.get('batch_local_threads', 0)) or get_container_vcpus()
+        torch.set_num_threads(threads)
+        print(f'Loaded local model in {time.time()-t1:.2f} seconds, {threads} intra-op threads')
+        _local_model = inference, inference.model_fn(model_dir)
+    return _local_model
+
+def embed_pages_locally(text_data: dict) -> Tuple[dict, dict]:
+    # Same output as utils.embed_pages_on_endpoint, computed in-process instead of through the endpoint
+    inference, model_and_tokenizer = load_local_model()
+    pagenums = [pagenum for pagenum, page in text_data.items() if page.strip()]
+    pages_per_call = LOCAL_PAGES_PER_CALL
+
+    embeddings_1d = {pagenum: {} for pagenum in text_data.keys()} # blank pages stay {}
+    t1 = time.time()
+    for i in range(0, len(pagenums), pages_per_call):
+        group = pagenums[i:i + pages_per_call]
+        embeddings = inference.predict_fn([text_data[pagenum] for pagenum in group], model_and_tokenizer)['embeddings']
+        embeddings_1d.update(zip(group, embeddings))
+        print(f'{i + len(group)}/{len(pagenums)} embedded locally')
+    print(f'Embedded {len(pagenums)}/{len(text_data)} pages in-process in {time.time()-t1:.2f} seconds')
+    return embeddings_1d, {'pages': len(text_data), 'embedded': len(pagenums), 'wall_seconds': round(time.time()-t1, 3)}
+
 #Process file embeddings
 def process_file_embeddings(bucket, key, input_folder, input_file):
     t1 = time.time()
@@ -43,29 +99,23 @@ def process_file_embeddings(bucket, key, input_folder, input_file):
     # Step 2: Download the text file from S3
     text_data = utils.load_s3_json(key=key, bucket=bucket, json_key=None)
     
-    # Step 3: Call SageMaker Endpoint to get embeddings, once per page
-    embeddings_1d = {} # dict like {str: (768,) }
-    for pagenum, page in text_data.items(): 
-        if page.strip():  # Check if the page is not empty or just whitespace
-            print(utils.get_current_pagenum(pagenum), '/', utils.get_max_pagenum(text_data))
-            embeddings_1d[pagenum] = utils.query_embeddings_endpoint(page)
-        else:
-            # Handle the case when the page is empty, e.g., logging or setting a default value
-            print(utils.get_current_pagenum(pagenum), '/', utils.get_max_pagenum(text_data), " / Has blank text")
-            embeddings_1d[pagenum] = {}  
-    
-    # Step 4: Prepare the output key and write embeddings to a new file in S3
+    # Step 3: Get embeddings, once per page -- in-process on this container's CPUs, or through
+    # the SageMaker Endpoint (concurrently, in page order). Blank pages are kept as {}
+    # Either way, pages unchanged since the existing embeddings file, or whose text is already in
+    # the page-embedding cache, are not re-embedded
     output_bucket, output_key, output_folder, output_file = output_file_from_input(bucket, input_folder, input_file)
-    embeddings_data = json.dumps(embeddings_1d)
+    # Vectors from the local model are cached and compared under their own model ID, not the endpoint's
+    if CONFIG.get('batch_embeddings_backend', 'endpoint') == 'local':
+        embed_fn, model_id = embed_pages_locally, utils.get_embedding_model_id(source='local')
+    else:
+        embed_fn, model_id = None, None
+    embeddings_1d, page_hashes, embedding_stats = utils.embed_pages_incremental(text_data, output_key, bucket=output_bucket, embed_fn=embed_fn, model_id=model_id) # dict like {str: (768,) }
     
-    s3.put_object(
-        Bucket=output_bucket,
-        Key=output_key,
-        Body=embeddings_data
-    )
+    # Step 4: Write embeddings to a new file in S3
+    utils.upload_page_embeddings(embeddings_1d, output_key=output_key, bucket=output_bucket, page_hashes=page_hashes)
     
     # Step 4.5: Log process end
-    utils.create_update_log_file(key=key, message="Page embeddings finished", job_start=False)
+    utils.create_update_log_file(key=key, message="Page embeddings finished", job_start=False, page_cache_hit_rate=embedding_stats.get('cache_hit_rate'))
 
     t2 = time.time()
     print(f'This took {t2-t1:.2f} seconds')
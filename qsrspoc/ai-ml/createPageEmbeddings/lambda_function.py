@@ -7,20 +7,9 @@ import time
 s3 = boto3.client('s3')
 batch_client = boto3.client('batch')
 
-# Get utils
-def get_bucket() -> str:
-    for possible_bucket in [
-        'qsrs-ocr-poc-dev',
-        'ahrq-qsrs-ml-poc'
-    ]:
-        x = boto3.resource('s3').Bucket(possible_bucket)
-        if x.creation_date is not None:
-            return possible_bucket
-    return None
-import sys
-sys.path.append('/tmp')
-s3.download_file(get_bucket(), 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
 
 # Get config file
 CONFIG = utils.get_config()
@@ -38,6 +27,10 @@ def output_file_from_input(input_bucket: str, input_folder: str, input_file: str
     return output_bucket, output_key, output_folder, output_file
 
 def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils, CONFIG
+    utils = bootstrap.load_utils()
+    CONFIG = utils.get_config()
     import time
     t1 = time.time()
     # EVENT: textract text output is cleaned, "cleaned" folder is added to
@@ -72,24 +65,16 @@ def lambda_handler(event, context):
         # Step 2: Download the text file from S3
         text_data = utils.load_s3_json(key=key, bucket=bucket, json_key=None)
         
-        # Step 3: Call SageMaker Endpoint to get embeddings, once per page
-        embeddings_1d = {} # dict like {str: (768,) }
-        for pagenum, page in text_data.items(): 
-            print(utils.get_current_pagenum(pagenum), '/', utils.get_max_pagenum(text_data))
-            embeddings_1d[pagenum] = utils.query_embeddings_endpoint(page)
-        
-        # Step 4: Prepare the output key and write embeddings to a new file in S3
+        # Step 3: Call SageMaker Endpoint to get embeddings (concurrently, in page order), only for
+        # pages that are new or changed since the existing embeddings file, if any
         output_bucket, output_key, output_folder, output_file = output_file_from_input(bucket, input_folder, input_file)
-        embeddings_data = json.dumps(embeddings_1d)
+        embeddings_1d, page_hashes, embedding_stats = utils.embed_pages_incremental(text_data, output_key, bucket=output_bucket) # dict like {str: (768,) }
         
-        s3.put_object(
-            Bucket=output_bucket,
-            Key=output_key,
-            Body=embeddings_data
-        )
+        # Step 4: Write embeddings to a new file in S3
+        utils.upload_page_embeddings(embeddings_1d, output_key=output_key, bucket=output_bucket, page_hashes=page_hashes)
         
         # Step 4.5: Log process end
-        utils.create_update_log_file(key=key, message="Page embeddings finished", job_start=False)
+        utils.create_update_log_file(key=key, message="Page embeddings finished", job_start=False, page_cache_hit_rate=embedding_stats.get('cache_hit_rate'))
 
         # Log start of LLM process
         time.sleep(1.1)
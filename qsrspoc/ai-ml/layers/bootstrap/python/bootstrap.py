@@ -0,0 +1,164 @@
+"""
+Loader of utils.py and config.json for the ai-ml Lambdas and the page embeddings Batch job.
+
+Ships once, in the qsrs-bootstrap layer (see ai-ml/layers/bootstrap-layer.txt), and is copied into
+the Batch image. It replaces the copy-pasted "probe buckets, download utils.py, import it" block. It:
+- resolves the code bucket from the QSRS_BUCKET environment variable, falling back to a
+  HEAD per candidate bucket instead of the ListBuckets call behind Bucket(...).creation_date
+- keeps versioned copies of utils.py and config.json in /tmp keyed by their S3 ETag, and
+  revalidates them with conditional GETs at most once per TTL (QSRS_BOOTSTRAP_TTL seconds).
+  The Lambdas call load_utils() at the start of every invocation, so a warm container picks up a
+  new utils.py or config.json within the TTL; inside it the call makes no request
+- hands the local config path to utils.get_config() through QSRS_CONFIG_PATH
+- times each phase and prints the breakdown
+"""
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import boto3
+import botocore
+
+CANDIDATE_BUCKETS = ['qsrs-ocr-poc-dev', 'ahrq-qsrs-ml-poc']
+CONFIG_BUCKET = 'ahrq-qsrs-ml-poc'
+UTILS_KEY = 'ai-ml/code/utils.py'
+CONFIG_KEY = 'config/ai-ml/config.json'
+CACHE_DIR = '/tmp/qsrs-bootstrap'
+DEFAULT_TTL = 300
+VERSIONS_TO_KEEP = 2
+
+s3 = boto3.client('s3')
+
+# Seconds spent in each bootstrap phase, e.g. {"resolve_bucket": 0.02, "utils.py": 0.08, ...}
+TIMINGS = {}
+
+def timed(phase: str):
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                TIMINGS[phase] = time.perf_counter() - start
+        return wrapper
+    return decorator
+
+@timed('resolve_bucket')
+def resolve_bucket() -> str:
+    bucket = os.environ.get('QSRS_BUCKET')
+    if bucket:
+        return bucket
+
+    # HEAD each candidate -- much cheaper than listing every bucket in the account
+    for possible_bucket in CANDIDATE_BUCKETS:
+        try:
+            s3.head_bucket(Bucket=possible_bucket)
+        except botocore.exceptions.ClientError:
+            continue
+        os.environ['QSRS_BUCKET'] = possible_bucket
+        return possible_bucket
+    return None
+
+def _load_meta(name: str) -> dict:
+    try:
+        with open(os.path.join(CACHE_DIR, f'{name}.meta.json')) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def _save_meta(name: str, meta: dict) -> None:
+    meta_file = os.path.join(CACHE_DIR, f'{name}.meta.json')
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+def _prune_versions(name: str, keep_path: str) -> None:
+    # Drop all but the newest few versioned copies of this file
+    prefix = f'{name}.'
+    versions = [
+        os.path.join(CACHE_DIR, f) for f in os.listdir(CACHE_DIR)
+        if f.startswith(prefix) and not f.endswith('.meta.json') and not f.endswith('.tmp')
+    ]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    for path in versions[VERSIONS_TO_KEEP:]:
+        if path != keep_path:
+            os.remove(path)
+
+def fetch_cached(bucket: str, key: str, ttl: int = None) -> str:
+    """
+    Returns a local path to an up-to-date copy of s3://bucket/key.
+
+    Within the TTL of the last check, the cached copy is used without any request. After it,
+    a conditional GET (If-None-Match on the cached ETag) either confirms the copy (304) or
+    downloads the new version to its own ETag-named file.
+    """
+    ttl = int(os.environ.get('QSRS_BOOTSTRAP_TTL', DEFAULT_TTL)) if ttl is None else ttl
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    name = os.path.basename(key)
+    meta = _load_meta(name)
+    cached_path = meta.get('path')
+    have_copy = cached_path is not None and os.path.exists(cached_path) and meta.get('bucket') == bucket
+
+    if have_copy and time.time() - meta.get('checked_at', 0) < ttl:
+        return cached_path
+
+    request = {'Bucket': bucket, 'Key': key}
+    if have_copy:
+        request['IfNoneMatch'] = meta['etag']
+
+    try:
+        response = s3.get_object(**request)
+    except botocore.exceptions.ClientError as e:
+        if have_copy and e.response['Error']['Code'] in ('304', 'NotModified'):
+            meta['checked_at'] = time.time()
+            _save_meta(name, meta)
+            return cached_path
+        raise
+
+    etag = response['ETag'].strip('"')
+    _, ext = os.path.splitext(name)
+    versioned_path = os.path.join(CACHE_DIR, f'{name}.{etag}{ext}')
+    with open(versioned_path + '.tmp', 'wb') as f:
+        f.write(response['Body'].read())
+    os.replace(versioned_path + '.tmp', versioned_path)
+
+    _save_meta(name, {'bucket': bucket, 'key': key, 'etag': response['ETag'], 'path': versioned_path, 'checked_at': time.time()})
+    _prune_versions(name, versioned_path)
+    return versioned_path
+
+@timed('import_utils')
+def _import_utils(utils_path: str, config_path: str):
+    # Import the versioned copy under the name "utils", reusing it if this exact version was loaded with
+    # this exact config (utils reads config.json at import, so a new config needs a fresh import too)
+    loaded = sys.modules.get('utils')
+    if loaded is not None and getattr(loaded, '__file__', None) == utils_path and getattr(loaded, '_bootstrap_config_path', None) == config_path:
+        return loaded
+
+    spec = importlib.util.spec_from_file_location('utils', utils_path)
+    module = importlib.util.module_from_spec(spec)
+    module._bootstrap_config_path = config_path
+    sys.modules['utils'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_utils(ttl: int = None):
+    # Resolve the bucket, refresh utils.py + config.json, then import utils (again only if either changed)
+    TIMINGS.clear()
+    bucket = resolve_bucket()
+
+    start = time.perf_counter()
+    utils_path = fetch_cached(bucket, UTILS_KEY, ttl=ttl)
+    TIMINGS['utils.py'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    config_path = fetch_cached(os.environ.get('QSRS_CONFIG_BUCKET', CONFIG_BUCKET), CONFIG_KEY, ttl=ttl)
+    TIMINGS['config.json'] = time.perf_counter() - start
+    os.environ['QSRS_CONFIG_PATH'] = config_path
+
+    loaded = sys.modules.get('utils')
+    utils = _import_utils(utils_path, config_path)
+    if utils is not loaded:
+        print('Bootstrap timings (s):', {phase: round(seconds, 4) for phase, seconds in TIMINGS.items()})
+    return utils
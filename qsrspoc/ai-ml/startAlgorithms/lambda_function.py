@@ -3,20 +3,9 @@ import boto3
 import time
 s3 = boto3.client('s3')
 stepfunctions_client = boto3.client("stepfunctions")
-# Get utils - 1
-def get_bucket() -> str:
-    for possible_bucket in [
-        'qsrs-ocr-poc-dev',
-        'ahrq-qsrs-ml-poc'
-    ]:
-        x = boto3.resource('s3').Bucket(possible_bucket)
-        if x.creation_date is not None:
-            return possible_bucket
-    return None
-import sys
-sys.path.append('/tmp')
-s3.download_file(get_bucket(), 'ai-ml/code/utils.py', '/tmp/utils.py')
-import utils
+# Get utils (ETag-versioned copy in /tmp, see ai-ml/layers/bootstrap-layer.txt)
+import bootstrap
+utils = bootstrap.load_utils()
 
 # Get config file
 CONFIG = utils.get_config()
@@ -31,11 +20,22 @@ def get_running_executions(step_function_ARN):
     return len(response.get("executions", []))
 
 def lambda_handler(event, context):
+    # Revalidate utils.py + config.json on every invocation, so a warm container picks up new versions
+    global utils, CONFIG
+    utils = bootstrap.load_utils()
+    CONFIG = utils.get_config()
     # EVENT: page-embeddings folder is added to
 
     # Process a single event
     record = event["Records"][0]
     s3_key = record["s3"]["object"]["key"]
+    # Only a document's page embeddings start the algorithms, not other objects written to the folder
+    if not s3_key.endswith(CONFIG['embeddings-extension']):
+        print(f"Skipping {s3_key}: does not end with {CONFIG['embeddings-extension']}")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'message': f'Skipped {s3_key}'})
+        }
     arn = CONFIG['main-algorithm-orchestrator-SF-arn']
     print(f"Processing file: {s3_key}")
     
@@ -49,11 +49,18 @@ def lambda_handler(event, context):
 
     # Step 2: Set up a new template file to hold data passed between step functions for this embedded file
     utils.create_initialize_data_passing_file(page_embeddings_key=key)
+
+    # Step 2.5: Make sure every question in prompts.json is already embedded before answerQuestion runs
+    # (only re-checked when prompts.json changed; otherwise a single HEAD)
+    if CONFIG.get('question-embedding-cache', False):
+        utils.build_question_embedding_cache()
     
     # Step 3: Start the "MainAlgorithmOrchestrator" step-function  
+    # "bypass_llm_cache" is passed down to every answerQuestion call of this run
+    bypass_llm_cache = event.get('bypass_llm_cache', CONFIG.get('llm-response-cache-bypass', False))
     stepfunctions_client.start_execution(
         stateMachineArn=arn,
-        input=json.dumps({"Records": event["Records"]})
+        input=json.dumps({"Records": event["Records"], "bypass_llm_cache": bool(bypass_llm_cache)})
     )
 
     # Log start of LLM process
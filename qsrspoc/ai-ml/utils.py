@@ -1,31 +1,98 @@
 import math
+import os
 import json
+import random
+import hashlib
 import re
+import struct
+import threading
+import time
 import urllib
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 import boto3
 import botocore
+import botocore.config
 
 from typing import Union, List, Tuple
+
+# numpy is only needed for the vectorized similarity engine -- Lambdas that never
+# score pages (e.g. cleanTextractOutput) can keep importing utils without the layer
+try:
+    import numpy as np
+except ImportError:
+    np = None
 		 
 
-s3 = boto3.client('s3')
+# region AWS client registry
+# Clients are created lazily, once per (service, region), and reused for the life of the
+# Lambda container or Batch process, so credentials, endpoints and TLS connections are not
+# re-resolved inside per-page / per-question loops. Settings can be overridden from config
+# "aws-client-settings": the config is read before any registry client is created, so the
+# settings apply to every one of them, including the module-level s3 client.
+CLIENT_SETTINGS = {
+    'max-pool-connections': 50,
+    'tcp-keepalive': True,
+    'retry-mode': 'adaptive',
+    'max-attempts': 5,
+    'connect-timeout': 10,
+    'read-timeout': 60,
+}
+# Synchronous Lambda invocations (answerQuestion) can run for minutes
+SERVICE_READ_TIMEOUTS = {'lambda': 900}
+
+_clients = {}
+_client_lock = threading.Lock() # boto3's default session is not thread-safe while creating clients
+
+def get_client(service_name: str, region_name: str = None):
+    client_key = (service_name, region_name)
+    client = _clients.get(client_key)
+    if client is not None:
+        return client
+
+    with _client_lock:
+        if client_key not in _clients:
+            client_config = botocore.config.Config(
+                max_pool_connections=int(CLIENT_SETTINGS['max-pool-connections']),
+                tcp_keepalive=bool(CLIENT_SETTINGS['tcp-keepalive']),
+                retries={'mode': CLIENT_SETTINGS['retry-mode'], 'max_attempts': int(CLIENT_SETTINGS['max-attempts'])},
+                connect_timeout=CLIENT_SETTINGS['connect-timeout'],
+                read_timeout=SERVICE_READ_TIMEOUTS.get(service_name, CLIENT_SETTINGS['read-timeout']),
+            )
+            _clients[client_key] = boto3.client(service_name, region_name=region_name, config=client_config)
+        return _clients[client_key]
+# endregion
 
 # Get config file
 def get_bucket() -> str:
+    # bootstrap.py resolves the bucket once and exports it
+    if os.environ.get('QSRS_BUCKET'):
+        return os.environ['QSRS_BUCKET']
     x = boto3.resource('s3').Bucket('ahrq-qsrs-ml-poc')
     if x.creation_date is not None:
         return 'ahrq-qsrs-ml-poc'
     return None
 
 def get_config() -> dict:
-    response = s3.get_object(Bucket='ahrq-qsrs-ml-poc', Key='config/ai-ml/config.json')
+    # Prefer the ETag-versioned local copy kept by bootstrap.py, else read it from S3
+    config_path = os.environ.get('QSRS_CONFIG_PATH')
+    if config_path and os.path.exists(config_path):
+        with open(config_path, encoding='utf-8') as f:
+            return json.loads(f.read(), strict=False)
+
+    # One-off client: the shared ones are built once "aws-client-settings" is known
+    response = boto3.client('s3').get_object(Bucket='ahrq-qsrs-ml-poc', Key='config/ai-ml/config.json')
     data = response['Body'].read().decode('utf-8')
     config = json.loads(data, strict=False)
     return config
 
 CONFIG = get_config()
+CLIENT_SETTINGS.update(CONFIG.get('aws-client-settings', {}))
+
+s3 = get_client('s3')
 
 BUCKET = CONFIG['bucket']
 
@@ -148,9 +215,9 @@ def get_current_pagenum(pgnum: str) -> int:
 def get_max_pagenum(text_data: dict) -> int:
     return max([get_current_pagenum(pgnum) for pgnum in text_data.keys()])
 
-def query_embeddings_endpoint(text: str):
-    # Is this best practices?
-    sagemaker_runtime = boto3.client('runtime.sagemaker', region_name='us-east-1')
+def query_embeddings_endpoint(text: Union[str, List[str]]):
+    # A list of texts is embedded in one request and returns one embedding per text, in order
+    sagemaker_runtime = get_client('runtime.sagemaker', region_name='us-east-1')
 
     # Prepare payload for SageMaker endpoint
     payload = json.dumps({"inputs": text})
@@ -167,6 +234,107 @@ def query_embeddings_endpoint(text: str):
 
     return embeddings_1d
 
+def query_embeddings_endpoint_many(texts: List[str], max_workers: int = 8) -> List[List[float]]:
+    # Embed several texts in one pass, returned in input order; identical texts are only sent once
+    unique_texts = list(dict.fromkeys(texts))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(unique_texts)))) as pool:
+        unique_embeddings = list(pool.map(query_embeddings_endpoint, unique_texts))
+
+    embeddings_by_text = dict(zip(unique_texts, unique_embeddings))
+    return [embeddings_by_text[text] for text in texts]
+
+# Error codes worth retrying at the page level, on top of the client's own retries
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException', 'Throttling', 'TooManyRequestsException',
+    'ServiceUnavailable', 'ModelNotReadyException', 'InternalFailure'
+}
+
+def query_embeddings_endpoint_with_retry(text: Union[str, List[str]], max_retries: int = 5, base_delay: float = 0.5) -> Tuple[List[float], int]:
+    # Returns (embedding, attempts); throttled calls back off exponentially with full jitter
+    for attempt in range(1, max_retries + 2):
+        try:
+            return query_embeddings_endpoint(text), attempt
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in THROTTLING_ERROR_CODES or attempt > max_retries:
+                raise
+            time.sleep(random.uniform(0, base_delay * 2 ** (attempt - 1)))
+
+def embed_pages_on_endpoint(text_data: dict, max_in_flight: int = None, max_retries: int = None, pages_per_request: int = None) -> Tuple[dict, dict]:
+    """
+    Embeds every page of a cleaned record concurrently through the SageMaker endpoint.
+    Use embed_pages, which consults the page-embedding cache first.
+
+    At most max_in_flight requests are outstanding at once (config "embedding-max-in-flight").
+    With pages_per_request > 1 (config "embedding-pages-per-request") each request carries a
+    list of pages, which the BioBERT handler embeds in padded mini-batches. Pages are
+    reassembled in the input order; blank pages map to {} so they stay in the output without
+    an endpoint call. Returns (embeddings, stats) where stats holds per-page latency (that of
+    the request carrying the page) and attempt counts.
+    """
+    max_in_flight = max_in_flight or CONFIG.get('embedding-max-in-flight', 8)
+    max_retries = CONFIG.get('embedding-max-retries', 5) if max_retries is None else max_retries
+    pages_per_request = max(1, pages_per_request or CONFIG.get('embedding-pages-per-request', 1))
+    max_pagenum = max([get_current_pagenum(pgnum) for pgnum in text_data.keys()], default=0)
+
+    def embed_group(pages: List[str]) -> Tuple[List[List[float]], int, float]:
+        start = time.perf_counter()
+        if pages_per_request == 1:
+            embedding, attempts = query_embeddings_endpoint_with_retry(pages[0], max_retries=max_retries)
+            embeddings = [embedding]
+        else:
+            embeddings, attempts = query_embeddings_endpoint_with_retry(pages, max_retries=max_retries)
+        return embeddings, attempts, time.perf_counter() - start
+
+    results = {}
+    latencies = {}
+    retried = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        to_embed = []
+        for pagenum, page in text_data.items():
+            if page.strip():
+                to_embed.append(pagenum)
+            else:
+                results[pagenum] = {}
+                print(get_current_pagenum(pagenum), '/', max_pagenum, " / Has blank text")
+
+        futures = {}
+        for i in range(0, len(to_embed), pages_per_request):
+            group = to_embed[i:i + pages_per_request]
+            futures[pool.submit(embed_group, [text_data[pagenum] for pagenum in group])] = group
+
+        done = 0
+        for future in as_completed(futures):
+            group = futures[future]
+            embeddings, attempts, latency = future.result()
+            for pagenum, embedding in zip(group, embeddings):
+                results[pagenum] = embedding
+                latencies[pagenum] = latency
+                if attempts > 1:
+                    retried[pagenum] = attempts
+            done += len(group)
+            print(f'{done}/{len(to_embed)} embedded (pages {get_current_pagenum(group[0])}-{get_current_pagenum(group[-1])}/{max_pagenum}, {latency:.2f}s)')
+
+    ordered = {pagenum: results[pagenum] for pagenum in text_data.keys()}
+
+    sorted_latencies = sorted(latencies.values())
+    stats = {
+        'pages': len(text_data),
+        'embedded': len(latencies),
+        'max_in_flight': max_in_flight,
+        'pages_per_request': pages_per_request,
+        'requests': len(futures),
+        'wall_seconds': round(time.perf_counter() - start, 3),
+        'latency_p50': round(sorted_latencies[len(sorted_latencies) // 2], 3) if sorted_latencies else 0.0,
+        'latency_max': round(sorted_latencies[-1], 3) if sorted_latencies else 0.0,
+        'latency_per_page': {pagenum: round(seconds, 3) for pagenum, seconds in latencies.items()},
+        'retried_pages': retried,
+    }
+    print(f"Embedded {stats['embedded']}/{stats['pages']} pages in {stats['wall_seconds']}s "
+          f"(p50 {stats['latency_p50']}s, max {stats['latency_max']}s, {len(retried)} retried)")
+    return ordered, stats
+
 def cosine_similarity(vec1: List[float], vec2: List[float]) -> float:
     """
     Computes the cosine similarity between two vectors.
@@ -202,6 +370,426 @@ def compute_similarity_weighted_confidence(similarity_scores):
     return weighted_score
 # endregion
 
+# region question embedding cache
+def get_embedding_model_id(source: str = 'endpoint') -> str:
+    # Identifies what produced an embedding: where it was computed, the model version and the inference
+    # backend, since int8/onnx vectors differ numerically from pytorch ones. Bump "embedding-model-version"
+    # whenever the weights change or the cleaned text changes shape, so no cache reuses older vectors.
+    # source "endpoint": the SageMaker endpoint, whose INFERENCE_BACKEND is mirrored by "embedding-inference-backend"
+    # source "local": the batch job's in-process copy of the model, which reads INFERENCE_BACKEND itself
+    version = CONFIG.get('embedding-model-version', '1')
+    if source == 'local':
+        backend = os.environ.get('INFERENCE_BACKEND', 'pytorch')
+        return f"local:{CONFIG.get('batch_local_model_prefix', '')}:{version}:{backend}"
+    if source != 'endpoint':
+        raise ValueError(f'Unknown embedding source "{source}"')
+    return f"{sagemaker_endpoint}:{version}:{CONFIG.get('embedding-inference-backend', 'pytorch')}"
+
+def question_embedding_cache_key(question: str, model_id: str) -> str:
+    # Hash of the exact question text AND the model, so a new model never reuses old vectors
+    return hashlib.sha256(f'{model_id}\n{question}'.encode('utf-8')).hexdigest()
+
+class QuestionEmbeddingCache:
+    """
+    Two-layer cache of question embeddings: an in-memory dict that lives as long as the
+    Lambda container, backed by one S3 object per question under a per-model prefix
+    (an S3PrefixCache), so concurrent writers never overwrite each other's entries.
+
+    Entries are keyed by a hash of the model ID and the question, and the prefix is named
+    after the model ID, so changing the endpoint or "embedding-model-version" starts from an
+    empty cache instead of reusing stale vectors.
+    """
+    PREBUILT_MARKER = 'prebuilt-prompts-etag'
+
+    def __init__(self, model_id: str = None, bucket: str = BUCKET, prefix: str = None, max_workers: int = 8):
+        self.model_id = model_id or get_embedding_model_id()
+        prefix = prefix or CONFIG.get('question-embedding-cache-prefix', 'ai-ml/cache/question-embeddings/')
+        self.backend = S3PrefixCache(prefix + re.sub(r'[^A-Za-z0-9._-]', '_', self.model_id), bucket=bucket)
+        self.key = self.backend.prefix
+        self.max_workers = max_workers
+        self._memory = {}
+        self._prebuilt_etag = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _fetch(self, cache_key: str) -> List[float]:
+        # Persisted layer; a hit is kept in memory for the life of the container
+        value = self.backend.get(cache_key)
+        if value is None:
+            return None
+        embedding = json.loads(value)
+        with self._lock:
+            self._memory[cache_key] = embedding
+        return embedding
+
+    def get(self, question: str) -> List[float]:
+        cache_key = question_embedding_cache_key(question, self.model_id)
+        embedding = self._memory.get(cache_key)
+        return embedding if embedding is not None else self._fetch(cache_key)
+
+    def put(self, question: str, embedding: List[float]) -> None:
+        cache_key = question_embedding_cache_key(question, self.model_id)
+        self.backend.put(cache_key, json.dumps(embedding).encode('utf-8'))
+        with self._lock:
+            self._memory[cache_key] = embedding
+
+    def get_or_embed_many(self, questions: List[str]) -> List[List[float]]:
+        # Only questions missing from both layers go to the SageMaker endpoint
+        unique_questions = list(dict.fromkeys(questions))
+        not_in_memory = [q for q in unique_questions if question_embedding_cache_key(q, self.model_id) not in self._memory]
+        if not_in_memory:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(not_in_memory)))) as pool:
+                list(pool.map(self.get, not_in_memory))
+
+        missing = [q for q in unique_questions if question_embedding_cache_key(q, self.model_id) not in self._memory]
+        self.hits += len(unique_questions) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            embeddings = query_embeddings_endpoint_many(missing, max_workers=self.max_workers)
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(missing)))) as pool:
+                list(pool.map(self.put, missing, embeddings))
+
+        return [self._memory[question_embedding_cache_key(q, self.model_id)] for q in questions]
+
+    def get_or_embed(self, question: str) -> List[float]:
+        return self.get_or_embed_many([question])[0]
+
+    def is_prebuilt(self, prompts_etag: str) -> bool:
+        # True if every question of this prompts.json version was already embedded into this cache
+        if self._prebuilt_etag is None:
+            marker = self.backend.get(self.PREBUILT_MARKER)
+            self._prebuilt_etag = marker.decode('utf-8') if marker is not None else None
+        return self._prebuilt_etag == prompts_etag
+
+    def mark_prebuilt(self, prompts_etag: str) -> None:
+        self.backend.put(self.PREBUILT_MARKER, prompts_etag.encode('utf-8'))
+        self._prebuilt_etag = prompts_etag
+
+_question_embedding_cache = None
+def get_question_embedding_cache() -> QuestionEmbeddingCache:
+    # One cache per container; recreated if the configured model changes
+    global _question_embedding_cache
+    if _question_embedding_cache is None or _question_embedding_cache.model_id != get_embedding_model_id():
+        _question_embedding_cache = QuestionEmbeddingCache()
+    return _question_embedding_cache
+
+def embed_questions(questions: List[str]) -> List[List[float]]:
+    # Entry point for answerQuestion: cache first (when enabled), endpoint on miss
+    if not CONFIG.get('question-embedding-cache', False):
+        return query_embeddings_endpoint_many(questions)
+    return get_question_embedding_cache().get_or_embed_many(questions)
+
+def build_question_embedding_cache(questions: dict = None) -> QuestionEmbeddingCache:
+    # Pre-embed every question in prompts.json, as load_questions() returns it ({algorithm: {key: prompt}})
+    # List-replace questions ("{race-list}") are embedded after substitution, so they are cached on first use instead
+    # Without explicit questions, this is a single HEAD of prompts.json unless prompts.json changed since the last build
+    cache = get_question_embedding_cache()
+    prompts_etag = None
+    if questions is None:
+        prompts_etag = s3.head_object(Bucket=CONFIG['bucket'], Key='ai-ml/code/prompts.json')['ETag']
+        if cache.is_prebuilt(prompts_etag):
+            return cache
+        questions = load_questions()
+
+    all_questions = [
+        prompt.split('|')[0]
+        for algorithm_prompts in questions.values()
+        for prompt in algorithm_prompts.values()
+    ]
+
+    cache.get_or_embed_many(all_questions)
+    if prompts_etag is not None:
+        cache.mark_prebuilt(prompts_etag)
+    print(f'Question embedding cache "{cache.key}": {cache.hits} questions already cached, {cache.misses} missing')
+    return cache
+# endregion
+
+# region similarity engine
+class PageSimilarityEngine:
+    """
+    Vectorized replacement for calling cosine_similarity() once per page.
+
+    A document's page embeddings are loaded once into a row-normalized float32 matrix
+    of shape [num_pages, hidden_size], so scoring a question against every page is a
+    single matrix-vector product, and the best pages are picked with argpartition
+    instead of sorting the whole document.
+
+    Pages with an empty embedding (blank pages written as {} by the batch job) are
+    left out of the matrix, since there is nothing to compare against.
+    """
+
+    def __init__(self, page_ids: List[str], matrix, all_page_ids: List[str] = None):
+        if np is None:
+            raise ImportError('PageSimilarityEngine requires numpy -- add the numpy layer to this Lambda')
+
+        self.page_ids = list(page_ids)
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[0] != len(self.page_ids):
+            raise ValueError(f'Expected a [{len(self.page_ids)}, hidden_size] matrix, got shape {matrix.shape}')
+
+        # Pre-normalize rows once so each question only needs a dot product
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.matrix = matrix / norms
+
+        # Page numbering in query_llm is relative to the first page of the whole document,
+        # including any blank pages that were dropped from the matrix
+        all_page_ids = self.page_ids if all_page_ids is None else list(all_page_ids)
+        self.first_page = min(all_page_ids) if all_page_ids else None
+
+    @classmethod
+    def from_embeddings(cls, embeddings: dict) -> 'PageSimilarityEngine':
+        # embeddings: dict like {pagenum: [768 floats]}, as stored in the page-embeddings file
+        page_ids = [pagenum for pagenum, vec in embeddings.items() if vec]
+        if not page_ids:
+            raise ValueError('No non-empty page embeddings to build the similarity engine from!')
+        matrix = np.array([embeddings[pagenum] for pagenum in page_ids], dtype=np.float32)
+        return cls(page_ids, matrix, all_page_ids=list(embeddings.keys()))
+
+    @classmethod
+    def from_binary(cls, source) -> 'PageSimilarityEngine':
+        # source: raw bytes of a binary page-embeddings file, or a local path to memory-map
+        page_ids, matrix, header = read_page_embeddings_binary(source)
+        blank_pages = set(header.get('blank_pages', []))
+        if blank_pages:
+            keep = [i for i, pagenum in enumerate(page_ids) if pagenum not in blank_pages]
+            matrix = matrix[keep]
+            non_blank_ids = [page_ids[i] for i in keep]
+        else:
+            non_blank_ids = page_ids
+        return cls(non_blank_ids, matrix, all_page_ids=page_ids)
+
+    def __len__(self) -> int:
+        return len(self.page_ids)
+
+    def score(self, question_embedding: List[float]):
+        # Cosine similarity of the question against every page, shape [num_pages]
+        q = np.asarray(question_embedding, dtype=np.float32)
+        if q.shape != (self.matrix.shape[1],):
+            raise ValueError("Vectors must be of the same length")
+
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0:
+            return np.zeros(len(self.page_ids), dtype=np.float32)
+        return self.matrix @ (q / q_norm)
+
+    def top_k(self, question_embedding: List[float], k: int = 10) -> List[Tuple[str, float]]:
+        # Best k pages as [(pagenum, similarity), ...], best first
+        scores = self.score(question_embedding)
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+
+        if k < len(scores):
+            best_idx = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best_idx = np.arange(len(scores))
+        best_idx = best_idx[np.argsort(-scores[best_idx], kind='stable')]
+
+        return [(self.page_ids[i], float(scores[i])) for i in best_idx]
+
+    def similarities(self, question_embedding: List[float], k: int = None) -> dict:
+        # Same shape as the old per-page dict comprehension, optionally limited to the best k pages
+        if k is None:
+            scores = self.score(question_embedding).tolist()
+            return dict(zip(self.page_ids, scores))
+        return dict(self.top_k(question_embedding, k=k))
+# endregion
+
+# region binary page embeddings
+# Layout: MAGIC | uint32 header length | JSON header (padded) | [num_pages, hidden_size] matrix
+# The matrix starts on a 64-byte boundary so it can be viewed with np.frombuffer / np.memmap
+# without copying. Blank pages are stored as zero rows and listed in the header, as are the
+# per-page text hashes used for incremental re-embedding (JSON artifacts keep those in a sidecar).
+EMBEDDINGS_MAGIC = b'QSRSEMB1'
+EMBEDDINGS_ALIGNMENT = 64
+
+# The binary matrix and the hashes sidecar live outside the page-embeddings folder, whose new objects
+# trigger startAlgorithms
+def get_embeddings_sidecar_key(embeddings_key: str, extension: str) -> str:
+    sidecar_folder = CONFIG.get('embeddings-sidecar-folder', 'ai-ml/cache/embeddings-artifacts/')
+    return embeddings_key.replace(CONFIG['embeddings-folder'], sidecar_folder, 1).replace(CONFIG['embeddings-extension'], extension)
+
+def get_binary_embeddings_key(embeddings_key: str) -> str:
+    # e.g. ai-ml/page-embeddings/X_embeddings.json --> ai-ml/cache/embeddings-artifacts/X_embeddings.bin
+    return get_embeddings_sidecar_key(embeddings_key, CONFIG.get('embeddings-binary-extension', 'embeddings.bin'))
+
+def get_page_hashes_key(embeddings_key: str) -> str:
+    # e.g. ai-ml/page-embeddings/X_embeddings.json --> ai-ml/cache/embeddings-artifacts/X_embeddings.hashes
+    return get_embeddings_sidecar_key(embeddings_key, CONFIG.get('embeddings-hashes-extension', 'embeddings.hashes'))
+
+def serialize_page_embeddings(embeddings: dict, dtype: str = 'float16', page_hashes: dict = None) -> bytes:
+    # embeddings: dict like {pagenum: [768 floats]}; blank pages may be {} or []
+    if np is None:
+        raise ImportError('Binary page embeddings require numpy')
+    if dtype not in ('float16', 'float32'):
+        raise ValueError(f'Unsupported embeddings dtype "{dtype}", expected float16 or float32')
+
+    page_ids = list(embeddings.keys())
+    blank_pages = [pagenum for pagenum in page_ids if not embeddings[pagenum]]
+    hidden_size = next((len(vec) for vec in embeddings.values() if vec), 0)
+
+    matrix = np.zeros((len(page_ids), hidden_size), dtype='<' + np.dtype(dtype).str[1:])
+    for i, pagenum in enumerate(page_ids):
+        if embeddings[pagenum]:
+            matrix[i] = embeddings[pagenum]
+
+    header = {
+        'version': 1,
+        'dtype': dtype,
+        'shape': [len(page_ids), hidden_size],
+        'page_ids': page_ids,
+        'blank_pages': blank_pages,
+    }
+    if page_hashes:
+        header['page_hashes'] = page_hashes
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    # Pad the header with spaces so the matrix starts on an aligned offset
+    prefix_len = len(EMBEDDINGS_MAGIC) + 4
+    data_offset = -(-(prefix_len + len(header_bytes)) // EMBEDDINGS_ALIGNMENT) * EMBEDDINGS_ALIGNMENT
+    header_bytes = header_bytes.ljust(data_offset - prefix_len, b' ')
+
+    return EMBEDDINGS_MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes + matrix.tobytes()
+
+def read_page_embeddings_binary(source) -> Tuple[List[str], 'np.ndarray', dict]:
+    """
+    Reads a binary page-embeddings file without copying the matrix.
+
+    Args:
+    - source (bytes | memoryview | str): raw file contents (viewed with np.frombuffer),
+      or a local file path (opened read-only with np.memmap).
+
+    Returns:
+    - page_ids (list of str), matrix ([num_pages, hidden_size], float16/float32), header (dict)
+    """
+    if np is None:
+        raise ImportError('Binary page embeddings require numpy')
+
+    # Read the fixed-size prefix and header, from either memory or disk
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            prefix = f.read(len(EMBEDDINGS_MAGIC) + 4)
+            magic, header_len = prefix[:len(EMBEDDINGS_MAGIC)], struct.unpack('<I', prefix[len(EMBEDDINGS_MAGIC):])[0]
+            header_bytes = f.read(header_len)
+    else:
+        source = memoryview(source)
+        magic = bytes(source[:len(EMBEDDINGS_MAGIC)])
+        header_len = struct.unpack('<I', source[len(EMBEDDINGS_MAGIC):len(EMBEDDINGS_MAGIC) + 4])[0]
+        header_bytes = bytes(source[len(EMBEDDINGS_MAGIC) + 4:len(EMBEDDINGS_MAGIC) + 4 + header_len])
+
+    if magic != EMBEDDINGS_MAGIC:
+        raise ValueError('Not a binary page-embeddings file (bad magic bytes)')
+
+    header = json.loads(header_bytes.decode('utf-8'))
+    dtype = np.dtype(header['dtype']).newbyteorder('<')
+    shape = tuple(header['shape'])
+    data_offset = len(EMBEDDINGS_MAGIC) + 4 + header_len
+
+    # View the matrix in place
+    if isinstance(source, str):
+        matrix = np.memmap(source, dtype=dtype, mode='r', offset=data_offset, shape=shape)
+    else:
+        matrix = np.frombuffer(source, dtype=dtype, count=shape[0] * shape[1], offset=data_offset).reshape(shape)
+
+    return header['page_ids'], matrix, header
+
+def upload_page_embeddings(embeddings: dict, output_key: str, bucket: str = BUCKET, page_hashes: dict = None) -> None:
+    """
+    Writes a document's page embeddings in the format selected by config "embeddings-format":
+    - "json":   legacy {pagenum: [768 floats]} text at output_key
+    - "binary": binary matrix at the .bin key (under embeddings-sidecar-folder), plus a small JSON manifest at output_key
+    - "both":   binary matrix plus the full legacy JSON
+
+    page_hashes ({pagenum: text hash}) go in the binary header, or in a sidecar under
+    embeddings-sidecar-folder for a JSON artifact, so the next run can re-embed only changed pages.
+
+    The object at output_key is always written last, because its creation triggers startAlgorithms.
+    """
+    embeddings_format = CONFIG.get('embeddings-format', 'json')
+    if embeddings_format not in ('json', 'binary', 'both'):
+        raise ValueError(f'Unknown embeddings-format "{embeddings_format}"')
+
+    if embeddings_format in ('binary', 'both'):
+        binary_key = get_binary_embeddings_key(output_key)
+        s3.put_object(
+            Bucket=bucket,
+            Key=binary_key,
+            Body=serialize_page_embeddings(embeddings, dtype=CONFIG.get('embeddings-binary-dtype', 'float16'), page_hashes=page_hashes),
+            ContentType='application/octet-stream'
+        )
+    elif page_hashes:
+        s3.put_object(Bucket=bucket, Key=get_page_hashes_key(output_key), Body=json.dumps(page_hashes))
+
+    if embeddings_format == 'binary':
+        body = {'format': 'binary', 'key': binary_key, 'pages': len(embeddings)}
+    else:
+        body = embeddings
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=output_key,
+        Body=json.dumps(body)
+    )
+
+def load_similarity_engine(embeddings_key: str, bucket: str = BUCKET) -> PageSimilarityEngine:
+    # Prefer the binary artifact when it is enabled; fall back to the JSON file (e.g. older documents)
+    if CONFIG.get('embeddings-format', 'json') in ('binary', 'both'):
+        try:
+            response = s3.get_object(Bucket=bucket, Key=get_binary_embeddings_key(embeddings_key))
+            return PageSimilarityEngine.from_binary(response['Body'].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            print(f'No binary page embeddings for "{embeddings_key}", falling back to JSON')
+
+    embeddings = load_s3_json(key=embeddings_key, bucket=bucket, json_key=None)
+
+    # A manifest written in "binary" mode points at the matrix instead of holding it
+    if embeddings.get('format') == 'binary':
+        response = s3.get_object(Bucket=bucket, Key=embeddings['key'])
+        return PageSimilarityEngine.from_binary(response['Body'].read())
+
+    return PageSimilarityEngine.from_embeddings(embeddings)
+
+def load_previous_page_embeddings(embeddings_key: str, bucket: str = BUCKET) -> Tuple[dict, dict]:
+    """
+    Reads an existing page-embeddings artifact with its per-page text hashes.
+    Returns (embeddings, page_hashes); both are empty when there is no artifact or it was
+    written without hashes, in which case every page is embedded again.
+    """
+    def get_bytes(key: str) -> bytes:
+        try:
+            return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    if CONFIG.get('embeddings-format', 'json') in ('binary', 'both') and np is not None:
+        body = get_bytes(get_binary_embeddings_key(embeddings_key))
+        if body is not None:
+            page_ids, matrix, header = read_page_embeddings_binary(body)
+            page_hashes = header.get('page_hashes', {})
+            blank_pages = set(header.get('blank_pages', []))
+            embeddings = {
+                pagenum: ([] if pagenum in blank_pages else matrix[i].astype(np.float32).tolist())
+                for i, pagenum in enumerate(page_ids) if pagenum in page_hashes
+            }
+            return embeddings, page_hashes
+
+    hashes_body = get_bytes(get_page_hashes_key(embeddings_key))
+    embeddings_body = get_bytes(embeddings_key) if hashes_body is not None else None
+    if embeddings_body is None:
+        return {}, {}
+    embeddings = json.loads(embeddings_body)
+    if embeddings.get('format') == 'binary':
+        return {}, {}
+    return embeddings, json.loads(hashes_body)
+# endregion
+
 # region step functions
 def construct_stepfunction_input(**kwargs):
     DEFAULT_FILE = CONFIG['default-file']
@@ -388,63 +976,493 @@ def construct_prompt_minus_context(question: str) -> str:
 
 # endregion
 
+# region cache backends
+# Small key -> bytes stores shared by the caches in this module. Keys are hex digests.
+class MemoryLRUCache:
+    """In-process LRU, evicting least-recently-used entries once max_bytes of values are held."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> bytes:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = value
+            self._size += len(value)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+class LocalDirectoryCache:
+    """One file per entry under a local directory (e.g. /tmp in Lambda, a volume in Batch)."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._file(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial entry
+        tmp_file = f'{file}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_file, file)
+
+class S3PrefixCache:
+    """One S3 object per entry under a prefix, shared by every Lambda and Batch job."""
+
+    def __init__(self, prefix: str, bucket: str = BUCKET):
+        self.bucket = bucket
+        self.prefix = prefix if prefix.endswith('/') else prefix + '/'
+
+    def get(self, key: str) -> bytes:
+        try:
+            return s3.get_object(Bucket=self.bucket, Key=self.prefix + key)['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    def put(self, key: str, value: bytes) -> None:
+        s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=value)
+
+class TieredCache:
+    """Checks tiers in order (e.g. memory, then S3); a hit in a later tier is copied into the earlier ones."""
+
+    def __init__(self, tiers: list):
+        self.tiers = tiers
+
+    def get(self, key: str) -> bytes:
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for earlier_tier in self.tiers[:i]:
+                    earlier_tier.put(key, value)
+                return value
+        return None
+
+    def put(self, key: str, value: bytes) -> None:
+        for tier in self.tiers:
+            tier.put(key, value)
+
+def create_cache_backend(cache_config: dict):
+    # cache_config like {"backend": "memory"|"local"|"s3"|"tiered"|"none", "max-bytes": ..., "path": ..., "prefix": ...}
+    # "tiered" takes {"tiers": [<cache_config>, ...]}, fastest first
+    backend = cache_config.get('backend', 'none')
+    if backend == 'tiered':
+        tiers = [tier for tier in map(create_cache_backend, cache_config.get('tiers', [])) if tier is not None]
+        return TieredCache(tiers) if tiers else None
+    if backend == 'memory':
+        return MemoryLRUCache(max_bytes=int(cache_config.get('max-bytes', 64 * 1024 * 1024)))
+    if backend == 'local':
+        return LocalDirectoryCache(cache_config['path'])
+    if backend == 's3':
+        return S3PrefixCache(cache_config['prefix'], bucket=cache_config.get('bucket', BUCKET))
+    if backend == 'none':
+        return None
+    raise ValueError(f'Unknown cache backend "{backend}"')
+# endregion
+
+# region LLM response cache
+LLM_MAX_OUTPUT_TOKENS = 2048
+LLM_INFERENCE_CONFIG = {"maxTokens": LLM_MAX_OUTPUT_TOKENS, "temperature": 0.3, "topP": 0.9}
+
+class LLMResponseCache:
+    """
+    Caches Bedrock responses so reruns of the orchestrator on unchanged prompts skip the model.
+    Keyed by model ID, inference config and a hash of the fully rendered prompt (context included),
+    so any change to the question, the cleaned text or the page selection is a miss.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_id: str, inference_config: dict, prompt: str) -> str:
+        key_material = json.dumps({
+            'model_id': model_id,
+            'inference_config': inference_config,
+            'prompt_sha256': hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+        }, sort_keys=True)
+        return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> str:
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return None if value is None else json.loads(value)['response']
+
+    def put(self, key: str, response_text: str) -> None:
+        self.backend.put(key, json.dumps({'response': response_text}).encode('utf-8'))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': (self.hits / total) if total else 0.0}
+
+_llm_response_cache = None
+def get_llm_response_cache() -> LLMResponseCache:
+    # Built once per container from config "llm-response-cache"; None when caching is off
+    global _llm_response_cache
+    if _llm_response_cache is None:
+        backend = create_cache_backend(CONFIG.get('llm-response-cache', {}))
+        _llm_response_cache = LLMResponseCache(backend) if backend is not None else False
+    return _llm_response_cache or None
+# endregion
+
+# region page embedding cache
+# Records share a lot of boilerplate pages (fax covers, consent forms, "page intentionally left
+# blank"); each distinct page text is embedded once per model and reused from then on.
+def normalize_page_text(text: str) -> str:
+    # Whitespace-only differences (OCR line breaks, trailing spaces) should not change the key
+    return ' '.join(text.split())
+
+def page_embedding_cache_key(text: str, model_id: str) -> str:
+    return hashlib.sha256(f'{model_id}\n{normalize_page_text(text)}'.encode('utf-8')).hexdigest()
+
+def pack_embedding(embedding: List[float]) -> bytes:
+    return struct.pack(f'<{len(embedding)}f', *embedding)
+
+def unpack_embedding(value: bytes) -> List[float]:
+    return list(struct.unpack(f'<{len(value) // 4}f', value))
+
+_page_embedding_cache = None
+
+def get_page_embedding_cache():
+    # Built once per container from config "page-embedding-cache"; None when caching is off
+    global _page_embedding_cache
+    if _page_embedding_cache is None:
+        backend = create_cache_backend(CONFIG.get('page-embedding-cache', {}))
+        _page_embedding_cache = backend if backend is not None else False
+    return _page_embedding_cache or None
+
+def embed_pages(text_data: dict, embed_fn=None, model_id: str = None, **kwargs) -> Tuple[dict, dict]:
+    """
+    Embeds every page of a cleaned record, reusing cached embeddings of identical page text.
+
+    Pages are looked up by a hash of their normalized text and the embedding model ID; pages
+    repeated within the record are embedded once. Only the remaining distinct texts go to
+    embed_fn (default embed_pages_on_endpoint, which gets **kwargs), and their embeddings are
+    cached. Pass the model_id of embed_fn when it is not the endpoint (get_embedding_model_id).
+    Returns (embeddings, stats) like embed_pages_on_endpoint, with the document's cache hit rate added.
+    """
+    embed_fn = embed_fn or (lambda pages: embed_pages_on_endpoint(pages, **kwargs))
+    cache = get_page_embedding_cache()
+    if cache is None:
+        return embed_fn(text_data)
+
+    model_id = model_id or get_embedding_model_id()
+    results = {}
+    keys = {} # pagenum -> cache key, for non-blank pages
+    for pagenum, page in text_data.items():
+        if page.strip():
+            keys[pagenum] = page_embedding_cache_key(page, model_id)
+        else:
+            results[pagenum] = {}
+
+    # One lookup per distinct key; the S3 tier is read concurrently
+    unique_keys = list(dict.fromkeys(keys.values()))
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(unique_keys)))) as pool:
+        cached = dict(zip(unique_keys, pool.map(cache.get, unique_keys)))
+
+    # First page carrying each missing text is embedded on behalf of all its duplicates
+    queued = set()
+    to_embed = {}
+    for pagenum, key in keys.items():
+        if cached[key] is None and key not in queued:
+            to_embed[pagenum] = key
+            queued.add(key)
+
+    stats = {}
+    if to_embed:
+        embeddings, stats = embed_fn({pagenum: text_data[pagenum] for pagenum in to_embed})
+        new_entries = {key: embeddings[pagenum] for pagenum, key in to_embed.items() if embeddings[pagenum]}
+        with ThreadPoolExecutor(max_workers=max(1, min(16, len(new_entries)))) as pool:
+            list(pool.map(lambda item: cache.put(item[0], pack_embedding(item[1])), new_entries.items()))
+        cached.update({key: pack_embedding(embedding) for key, embedding in new_entries.items()})
+
+    for pagenum, key in keys.items():
+        results[pagenum] = unpack_embedding(cached[key]) if cached[key] else {}
+    ordered = {pagenum: results[pagenum] for pagenum in text_data.keys()}
+
+    cache_hits = sum(1 for pagenum in keys if pagenum not in to_embed)
+    stats = dict(stats)
+    stats.update({
+        'pages': len(text_data),
+        'cache_hits': cache_hits,
+        'cache_misses': len(to_embed),
+        'cache_hit_rate': round(cache_hits / len(keys), 4) if keys else 0.0,
+    })
+    print(f"Page-embedding cache: {cache_hits}/{len(keys)} non-blank pages reused "
+          f"({stats['cache_hit_rate']:.1%}), {len(to_embed)} embedded")
+    return ordered, stats
+
+def embed_pages_incremental(text_data: dict, embeddings_key: str, bucket: str = BUCKET, embed_fn=None, model_id: str = None) -> Tuple[dict, dict, dict]:
+    """
+    Re-embeds only the pages of a regenerated cleaned-data file whose text changed.
+
+    Each page's hash (page_embedding_cache_key: model ID + normalized text) is compared with
+    the hashes stored in the existing artifact at embeddings_key. Unchanged pages keep their
+    vector, changed and new pages go through embed_pages, and pages no longer in text_data
+    are dropped. Returns (embeddings, page_hashes, stats); pass page_hashes on to
+    upload_page_embeddings. model_id is embed_fn's, as for embed_pages.
+    """
+    model_id = model_id or get_embedding_model_id()
+    page_hashes = {pagenum: page_embedding_cache_key(page, model_id) for pagenum, page in text_data.items() if page.strip()}
+    previous_embeddings, previous_hashes = load_previous_page_embeddings(embeddings_key, bucket=bucket)
+
+    reused = {
+        pagenum: previous_embeddings[pagenum] for pagenum, page_hash in page_hashes.items()
+        if previous_hashes.get(pagenum) == page_hash and previous_embeddings.get(pagenum)
+    }
+    changed = {pagenum: page for pagenum, page in text_data.items() if pagenum not in reused}
+
+    stats = {}
+    embeddings = {}
+    if changed:
+        embeddings, stats = embed_pages(changed, embed_fn=embed_fn, model_id=model_id)
+    embeddings.update(reused)
+    ordered = {pagenum: embeddings[pagenum] for pagenum in text_data.keys()}
+
+    stats = dict(stats)
+    stats.update({
+        'pages': len(text_data),
+        'reused_pages': len(reused),
+        'reembedded_pages': sum(1 for pagenum in changed if pagenum in page_hashes),
+        'dropped_pages': len(set(previous_hashes) - set(text_data)),
+    })
+    if previous_hashes:
+        print(f"Incremental embedding: {stats['reused_pages']} pages unchanged, {stats['reembedded_pages']} re-embedded, "
+              f"{stats['dropped_pages']} dropped")
+    return ordered, page_hashes, stats
+# endregion
+
 # region querying LLLM
+# Local token counting, so the context can be sized before calling Bedrock instead of
+# shrinking it after "maximum context length" errors. Without the model's own tokenizer
+# file, tokens are estimated from characters and words, erring on the high side.
+PAGE_BREAK = '\n---PAGE BREAK---\n'
+MODEL_TOKEN_PROFILES = {
+    'meta.llama3': {'chars_per_token': 3.2, 'tokens_per_word': 1.5, 'context_window': 128000},
+    'anthropic.claude': {'chars_per_token': 3.0, 'tokens_per_word': 1.6, 'context_window': 200000},
+    'mistral': {'chars_per_token': 3.0, 'tokens_per_word': 1.6, 'context_window': 32000},
+    'amazon': {'chars_per_token': 3.0, 'tokens_per_word': 1.6, 'context_window': 32000},
+}
+DEFAULT_TOKEN_PROFILE = {'chars_per_token': 3.0, 'tokens_per_word': 1.6, 'context_window': 8000}
+
+def get_model_token_profile(model_id: str = CONFIG['model-id']) -> dict:
+    # model_id may carry a cross-region prefix, e.g. "us.meta.llama3-2-90b-instruct-v1:0"
+    for family, profile in MODEL_TOKEN_PROFILES.items():
+        if family in model_id:
+            return profile
+    return DEFAULT_TOKEN_PROFILE
+
+_llm_tokenizer = None
+def get_llm_tokenizer():
+    # Exact counting when a HuggingFace tokenizer.json for the model is configured and `tokenizers` is installed
+    global _llm_tokenizer
+    tokenizer_path = CONFIG.get('llm-tokenizer-path')
+    if _llm_tokenizer is None and tokenizer_path:
+        try:
+            from tokenizers import Tokenizer
+            _llm_tokenizer = Tokenizer.from_file(tokenizer_path)
+        except Exception as e:
+            print(f'Could not load LLM tokenizer "{tokenizer_path}", estimating token counts instead: {e}')
+            _llm_tokenizer = False
+    return _llm_tokenizer or None
+
+def count_tokens(text: str, model_id: str = CONFIG['model-id']) -> int:
+    tokenizer = get_llm_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+    profile = get_model_token_profile(model_id)
+    by_chars = len(text) / profile['chars_per_token']
+    by_words = len(text.split()) * profile['tokens_per_word']
+    return int(math.ceil(max(by_chars, by_words)))
+
+def get_prompt_token_budget(model_id: str = CONFIG['model-id']) -> int:
+    # Total prompt tokens (instructions + question + context) allowed per request
+    budget = CONFIG.get('llm-prompt-token-budget')
+    if budget:
+        return int(budget)
+    return get_model_token_profile(model_id)['context_window'] - LLM_MAX_OUTPUT_TOKENS
+
+def truncate_to_tokens(text: str, max_tokens: int, model_id: str = CONFIG['model-id']) -> Tuple[str, int]:
+    # Keep as many leading lines as fit; when not even the first line fits (e.g. comma-joined
+    # structured text on one line), keep the longest prefix of it that fits instead
+    kept_lines, kept_tokens = [], 0
+    for line in text.split('\n'):
+        line_tokens = count_tokens(line + '\n', model_id)
+        if kept_tokens + line_tokens > max_tokens:
+            break
+        kept_lines.append(line)
+        kept_tokens += line_tokens
+    if kept_lines:
+        return '\n'.join(kept_lines), kept_tokens
+
+    first_line = text.split('\n', 1)[0]
+    low, high = 0, len(first_line)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(first_line[:mid], model_id) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    prefix = first_line[:low]
+    return prefix, count_tokens(prefix, model_id) if prefix else 0
+
+def pack_context(
+    pages_ranked: List[str],
+    all_page_text: dict,
+    token_budget: int,
+    model_id: str = CONFIG['model-id'],
+    separator: str = PAGE_BREAK
+) -> Tuple[str, List[str], int]:
+    """
+    Greedily fills a token budget with the best-ranked pages.
+
+    Every page that fits whole is added, in rank order; pages that do not fit are skipped
+    rather than ending the packing. The best skipped page is then truncated into whatever
+    budget is left, so the top page is always represented when nothing else fits.
+
+    Args:
+    - pages_ranked (list of str): page numbers, best first.
+    - all_page_text (dict of str:str): page text by page number.
+    - token_budget (int): tokens available for the context.
+
+    Returns:
+    - context (str), pages used (list of str), context tokens (int)
+    """
+    separator_tokens = count_tokens(separator, model_id)
+    parts, pages_used, used = [], [], 0
+    skipped = []
+
+    for pagenum in pages_ranked:
+        page_text = all_page_text[pagenum]
+        overhead = separator_tokens if parts else 0
+        page_tokens = count_tokens(page_text, model_id)
+
+        # Whole page fits
+        if used + overhead + page_tokens <= token_budget:
+            parts.append(page_text)
+            pages_used.append(pagenum)
+            used += overhead + page_tokens
+        else:
+            skipped.append(pagenum)
+
+    # Use up the rest of the budget with the leading part of the best page that did not fit
+    if skipped:
+        overhead = separator_tokens if parts else 0
+        remaining = token_budget - used - overhead
+        if remaining > 0:
+            truncated, truncated_tokens = truncate_to_tokens(all_page_text[skipped[0]], remaining, model_id)
+            if truncated.strip():
+                parts.append(truncated)
+                pages_used.append(skipped[0])
+                used += overhead + truncated_tokens
+
+    return separator.join(parts), pages_used, used
+
 def query_llm(
     prompt_minus_context: str,
     similarities_dict: dict,
     all_page_text: dict,
     context_replace: str = '{context}',
     num_pages: int = 8,
-    prnt: bool = True
-) -> Tuple[str, List]:
-    # Recursion stop gate
-    if num_pages == 0:
+    prnt: bool = True,
+    first_page: str = None,
+    token_budget: int = None,
+    model_id: str = CONFIG['model-id'],
+    use_cache: bool = True
+) -> Tuple[str, List, float, int]:
+    # Sort best pages down to worst pages
+    best_pages_sorted = sorted(similarities_dict.keys(), key=lambda k: similarities_dict[k], reverse=True)
+    print(best_pages_sorted[:10])
+
+    # Fill whatever the instructions + question leave of the budget with up to num_pages of the best pages
+    if token_budget is None: token_budget = get_prompt_token_budget(model_id)
+    instruction_tokens = count_tokens(prompt_minus_context, model_id)
+    context, pages_used, context_tokens = pack_context(
+        best_pages_sorted[:num_pages], all_page_text, token_budget - instruction_tokens, model_id=model_id
+    )
+    if not pages_used:
         raise ValueError('Cannot answer the question with 0 pages of context!')
-    
-    # Try to query with this much context
-    try:
-        # Sort best pages down to worst pages
-        best_pages_sorted = sorted(similarities_dict.keys(), key=lambda k: similarities_dict[k], reverse=True)
-        pages_used = best_pages_sorted[:num_pages]
-
-        # get the similarity scores for the pages used and generate a confidence metric based on them
-        scores_for_used_pages = [similarities_dict[page] for page in pages_used if page in similarities_dict]
-        weighted_aggregate_page_confidence = compute_similarity_weighted_confidence(scores_for_used_pages)
+    prompt_tokens = instruction_tokens + context_tokens
+    if prnt: print(f'Packed {len(pages_used)} pages into {prompt_tokens} of {token_budget} prompt tokens')
 
-        pages_used_starts_from_1 = [int(p) - int(min(best_pages_sorted))+1 for p in pages_used] # e.g. [-1, 0, 1, ...] --> [1, 2, 3, ...]
-        print(best_pages_sorted[:10])
+    # get the similarity scores for the pages used and generate a confidence metric based on them
+    scores_for_used_pages = [similarities_dict[page] for page in pages_used if page in similarities_dict]
+    weighted_aggregate_page_confidence = compute_similarity_weighted_confidence(scores_for_used_pages)
 
-        # Get N pages of context from similarities dict
-        context = '\n---PAGE BREAK---\n'.join([
-            all_page_text[pagenum] for pagenum in pages_used
-        ])
+    # similarities_dict may only hold the top-k pages, so the caller can pass the document's first page
+    if first_page is None: first_page = min(best_pages_sorted)
+    pages_used_starts_from_1 = [int(p) - int(first_page)+1 for p in pages_used] # e.g. [-1, 0, 1, ...] --> [1, 2, 3, ...]
 
-        # Populate prompt with context
-        prompt = prompt_minus_context.replace(context_replace, context)
+    # Populate prompt with context
+    prompt = prompt_minus_context.replace(context_replace, context)
 
+    try:
         # Query LLM and return
-        answer_plus_reason = query_llm_helper(prompt)
-        return answer_plus_reason, pages_used_starts_from_1, weighted_aggregate_page_confidence
+        answer_plus_reason = query_llm_helper(prompt, model_id=model_id, use_cache=use_cache)
+        return answer_plus_reason, pages_used_starts_from_1, weighted_aggregate_page_confidence, prompt_tokens
 
     except Exception as e:
-        
         e_str = str(e).lower()
-        # Check if the error is related to the input text being too long (too many tokens)
+        # Token counts are estimates -- if the model still rejects the prompt, shrink the budget and re-pack once more
         if ("model's maximum context length" in e_str) and ("please reduce the length of the prompt" in e_str):
-            if prnt: print(f"Context may be too long with {num_pages} pages, trying next with {num_pages-1} pages.")
-
-            # Try again with one less page of context
+            smaller_budget = int(prompt_tokens * 0.8)
+            if prnt: print(f"Prompt rejected at ~{prompt_tokens} tokens, re-packing with a budget of {smaller_budget} tokens.")
             return query_llm(prompt_minus_context, similarities_dict=similarities_dict, all_page_text=all_page_text,
-                             context_replace=context_replace, num_pages=num_pages-1, prnt=prnt)
-        
-        else:
-            # For other exceptions, raise the error
-            raise
+                             context_replace=context_replace, num_pages=num_pages, prnt=prnt, first_page=first_page,
+                             token_budget=smaller_budget, model_id=model_id, use_cache=use_cache)
+
+        # For other exceptions, raise the error
+        raise
 
-def query_llm_helper(prompt: str, model_id: str = CONFIG['model-id']) -> str:
-    bedrock = boto3.client('bedrock-runtime')
+def query_llm_helper(prompt: str, model_id: str = CONFIG['model-id'], use_cache: bool = True) -> str:
     # Input: long text string
     # Output: response text from the LLM
+
+    # Reuse the response from an earlier run for the exact same prompt; use_cache=False
+    # skips the lookup (the fresh response still refreshes the cache)
+    cache = get_llm_response_cache()
+    if cache is not None:
+        cache_key = LLMResponseCache.make_key(model_id, LLM_INFERENCE_CONFIG, prompt)
+        if use_cache:
+            cached_response = cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+
+    bedrock = get_client('bedrock-runtime')
     conversation = [
         {
             "role": "user",
@@ -456,7 +1474,7 @@ def query_llm_helper(prompt: str, model_id: str = CONFIG['model-id']) -> str:
     response = bedrock.converse(
         modelId=model_id,
         messages=conversation,
-        inferenceConfig={"maxTokens":2048,"temperature":0.3,"topP":0.9},
+        inferenceConfig=LLM_INFERENCE_CONFIG,
         additionalModelRequestFields={},
     )
 
@@ -470,6 +1488,8 @@ def query_llm_helper(prompt: str, model_id: str = CONFIG['model-id']) -> str:
 
     # Extract and return the response text.
     response_text = response["output"]["message"]["content"][0]["text"]
+    if cache is not None:
+        cache.put(cache_key, response_text)
     return response_text
 
 def invoke_querying_lambda(
@@ -480,7 +1500,7 @@ def invoke_querying_lambda(
     asynchronous: bool = False
 ) -> dict:
     
-    lambda_client = boto3.client('lambda')
+    lambda_client = get_client('lambda')
 
     # Prepare payload to invoke
     FUNCTION_NAME = 'answerQuestion'
@@ -588,8 +1608,13 @@ def create_update_log_file(key: str, message: str, job_start: bool, bucket: str
         "message": message
     }
     body.update(kwargs)
+
+    # Append-only when "log-format" is "ndjson": one small NDJSON object per event, partitioned by date/hour
+    if CONFIG.get('log-format', 'json-array') == 'ndjson':
+        append_log_event(body, bucket=bucket)
+        return
     
-    # If file exists, download and append; else, create new output
+    # Legacy "json-array" format: if file exists, download and append; else, create new output
     if check_file_exists(key=logfile_key, bucket=bucket):
         log_data = load_s3_json(key=logfile_key, bucket=bucket, json_key=None)
         log_data.append(body)
@@ -602,4 +1627,104 @@ def create_update_log_file(key: str, message: str, job_start: bool, bucket: str
         Key=logfile_key,
         Body=json.dumps(log_data)
     )
+
+def get_log_events_prefix() -> str:
+    return CONFIG.get('logEventsPrefix', 'logs/events/')
+
+def get_log_daily_prefix() -> str:
+    return CONFIG.get('logDailyPrefix', 'logs/daily/')
+
+def append_log_event(body: dict, bucket: str = BUCKET) -> str:
+    # Write one event as its own object -- concurrent writers never touch the same key
+    now = datetime.now()
+    event_key = (
+        f"{get_log_events_prefix()}dt={now.strftime('%Y-%m-%d')}/hr={now.strftime('%H')}/"
+        f"{now.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:12]}.ndjson"
+    )
+    s3.put_object(Bucket=bucket, Key=event_key, Body=json.dumps(body) + '\n', ContentType='application/x-ndjson')
+    return event_key
+
+def list_keys(prefix: str, bucket: str = BUCKET, start_after: str = None) -> List[str]:
+    # Paginated listing, so prefixes with more than 1000 objects are read in full
+    paginator = s3.get_paginator('list_objects_v2')
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    keys = []
+    for page in paginator.paginate(**params):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return keys
+
+def _read_ndjson(key: str, bucket: str = BUCKET) -> List[dict]:
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+def get_daily_log_key(day: str) -> str:
+    return f"{get_log_daily_prefix()}process_log_{day}.ndjson"
+
+def compact_process_logs(day: str, bucket: str = BUCKET, delete_events: bool = True) -> dict:
+    """
+    Folds one day's event objects (dt=YYYY-MM-DD/...) into a single daily NDJSON file.
+
+    Each daily line records the event object it came from in "event_key". Events already
+    present in the daily file, whether they came from a run that deleted its event objects or
+    from one that kept them (delete_events=False), are not added again, so re-running the
+    compactor for the same day is safe. Event objects are deleted only after the daily file is written.
+    """
+    event_keys = sorted(list_keys(f"{get_log_events_prefix()}dt={day}/", bucket=bucket))
+    daily_key = get_daily_log_key(day)
+
+    lines, compacted_keys = [], set()
+    if check_file_exists(key=daily_key, bucket=bucket):
+        lines = s3.get_object(Bucket=bucket, Key=daily_key)['Body'].read().decode('utf-8').splitlines()
+        compacted_keys = {json.loads(line).get('event_key') for line in lines if line.strip()}
+    new_keys = [key for key in event_keys if key not in compacted_keys]
+    for key in new_keys:
+        lines.extend(json.dumps({**event, 'event_key': key}) for event in _read_ndjson(key, bucket=bucket))
+
+    if new_keys:
+        s3.put_object(Bucket=bucket, Key=daily_key, Body='\n'.join(lines) + '\n', ContentType='application/x-ndjson')
+    if event_keys:
+        if delete_events:
+            # delete_objects accepts at most 1000 keys per call
+            for i in range(0, len(event_keys), 1000):
+                s3.delete_objects(
+                    Bucket=bucket,
+                    Delete={'Objects': [{'Key': key} for key in event_keys[i:i + 1000]], 'Quiet': True}
+                )
+
+    return {'day': day, 'daily_key': daily_key, 'events_compacted': len(new_keys), 'total_events': len(lines)}
+
+def iter_log_events(start_day: str = None, bucket: str = BUCKET):
+    """
+    Yields process-log events from start_day (YYYY-MM-DD) onwards: compacted daily files
+    first, then any event objects the compactor has not folded in yet (event objects kept
+    after compaction are skipped).
+
+    The event objects are listed before the daily files are read: an event deleted by a
+    concurrent compaction after the listing is then already in the daily file read next,
+    and its missing object is skipped.
+    """
+    events_prefix = get_log_events_prefix()
+    start_after = f"{events_prefix}dt={start_day}" if start_day else None
+    event_keys = sorted(list_keys(events_prefix, bucket=bucket, start_after=start_after))
+
+    compacted_keys = set()
+    daily_prefix = get_log_daily_prefix()
+    start_after = f"{daily_prefix}process_log_{start_day}" if start_day else None
+    for key in sorted(list_keys(daily_prefix, bucket=bucket, start_after=start_after)):
+        for event in _read_ndjson(key, bucket=bucket):
+            compacted_keys.add(event.get('event_key'))
+            yield event
+
+    for key in event_keys:
+        if key in compacted_keys:
+            continue
+        try:
+            events = _read_ndjson(key, bucket=bucket)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
+            continue
+        yield from events
 # endregion
\ No newline at end of file
@@ -6,6 +6,39 @@ from datetime import datetime
 
 s3_client = boto3.client('s3')
 
+# Process-log layouts (see utils.create_update_log_file): per-event NDJSON objects are
+# converted one-to-one; compacted daily files only re-contain events already converted
+LOG_EVENTS_SUFFIX = ".ndjson"
+LOG_DAILY_PREFIX = "logs/daily/"
+
+# Function to extract only the original PDF filename
+def extract_original_filename(filepath):
+    match = re.match(r'^(?:.*/)?([^_/]+_Redacted)', filepath)  # Extract clean filename
+    return match.group(1) + ".pdf" if match else ""
+
+# Transform records and correctly extract "File"
+def transform_records(records):
+    transformed_records = []
+    for record in records:
+        original_filename = extract_original_filename(record.get("filepath", ""))
+
+        transformed_record = {
+            "Bucket Name": record.get("bucketname", ""),
+            "File Path": record.get("filepath", ""),
+            "File": original_filename,  # Extracts clean file name
+            "Execution Datetime": record.get("datetime", ""),
+            "File Size": record.get("filesize", ""),
+            "Page Count": None if record.get("pagecount") == "NA" else record.get("pagecount"),  # Convert "NA" to None
+            "Status": record.get("status", ""),
+            "Message": record.get("message", "")
+        }
+        # Add "Num Question" only if it exists in the original record
+        if "num_questions" in record:
+            transformed_record["Num Question"] = record["num_questions"]
+
+        transformed_records.append(json.dumps(transformed_record))
+    return transformed_records
+
 def lambda_handler(event, context):
     try:
         source_bucket = event['Records'][0]['s3']['bucket']['name']  # Bucket Name
@@ -13,9 +46,25 @@ def lambda_handler(event, context):
         destination_bucket = "log-files-for-athena"
         destination_key = f"converted_{source_key}"
 
+        if source_key.startswith(LOG_DAILY_PREFIX):
+            print(f"Skipping compacted log file {source_key}")
+            return
+
         # Fetch the source file
         response = s3_client.get_object(Bucket=source_bucket, Key=source_key)
         source_content = response['Body'].read().decode('utf-8')
+
+        # Append-only event object: convert it to its own destination object, no read-modify-write
+        if source_key.endswith(LOG_EVENTS_SUFFIX):
+            records = [json.loads(line) for line in source_content.splitlines() if line.strip()]
+            s3_client.put_object(
+                Bucket=destination_bucket,
+                Key=destination_key,
+                Body="\n".join(transform_records(records))
+            )
+            print(f"Event file converted to {destination_bucket}/{destination_key} at {datetime.now()}")
+            return
+
         new_records = json.loads(source_content)
         print(f"New records: {new_records}")
 
@@ -42,32 +91,7 @@ def lambda_handler(event, context):
 
         print(f"Existing records: {existing_records}")
 
-        # Function to extract only the original PDF filename
-        def extract_original_filename(filepath):
-            match = re.match(r'^(?:.*/)?([^_/]+_Redacted)', filepath)  # Extract clean filename
-            return match.group(1) + ".pdf" if match else ""
-
-
-        # Transform records and correctly extract "File"
-        transformed_records = []
-        for record in new_data_records:
-            original_filename = extract_original_filename(record.get("filepath", ""))
-
-            transformed_record = {
-                "Bucket Name": record.get("bucketname", ""),
-                "File Path": record.get("filepath", ""),
-                "File": original_filename,  # Extracts clean file name
-                "Execution Datetime": record.get("datetime", ""),
-                "File Size": record.get("filesize", ""),
-                "Page Count": None if record.get("pagecount") == "NA" else record.get("pagecount"),  # Convert "NA" to None
-                "Status": record.get("status", ""),
-                "Message": record.get("message", "")
-            }
-            # Add "Num Question" only if it exists in the original record
-            if "num_questions" in record:
-                transformed_record["Num Question"] = record["num_questions"]
-
-            transformed_records.append(json.dumps(transformed_record))
+        transformed_records = transform_records(new_data_records)
 
         combined_records = existing_records + transformed_records
         combined_content = "\n".join(combined_records)
@@ -1,11 +1,50 @@
+import boto3
 import psycopg2
 import json
 import re
 from datetime import datetime
 
-# Load the JSON file
-with open('C:\\AHRQ Project\\JSON To PostgreSQL Data Insertion\\Data\\process_log_032025.json') as file:
-    data = json.load(file)
+# Process log source: "s3" reads the append-only NDJSON layout (logs/daily + logs/events),
+# "file" reads a legacy monthly JSON array export. Switch to "s3" together with the cut-over of
+# "log-format" (ai-ml config) and "ocr_processlog_format" (OCR config) to "ndjson"
+LOG_SOURCE = "file"
+LOG_BUCKET = "ahrq-qsrs-ml-poc"
+LOG_DAILY_PREFIX = "logs/daily/"
+LOG_EVENTS_PREFIX = "logs/events/"
+LOG_FILE = 'C:\\AHRQ Project\\JSON To PostgreSQL Data Insertion\\Data\\process_log_032025.json'
+
+def list_keys(s3, prefix, start_after=None):
+    params = {'Bucket': LOG_BUCKET, 'Prefix': prefix}
+    if start_after:
+        params['StartAfter'] = start_after
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(**params):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return sorted(keys)
+
+def load_s3_log_entries(start_day):
+    # Only partitions on/after the latest day already in the DB are read
+    s3 = boto3.client('s3')
+    # List the event objects before reading the daily files: an event deleted by a concurrent
+    # compaction after this listing is already in the daily file, and its missing object is skipped
+    event_keys = list_keys(s3, LOG_EVENTS_PREFIX, start_after=f"{LOG_EVENTS_PREFIX}dt={start_day}")
+    keys = list_keys(s3, LOG_DAILY_PREFIX, start_after=f"{LOG_DAILY_PREFIX}process_log_{start_day}") + event_keys
+    entries = []
+    compacted_keys = set()  # event objects already folded into a daily file (kept when delete_events is off)
+    for key in keys:
+        if key in compacted_keys:
+            continue
+        try:
+            body = s3.get_object(Bucket=LOG_BUCKET, Key=key)['Body'].read().decode('utf-8')
+        except s3.exceptions.NoSuchKey:
+            continue
+        for line in body.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                compacted_keys.add(entry.get('event_key'))
+                entries.append(entry)
+    print(f"Read {len(entries)} log entries from {len(keys)} objects (from {start_day})")
+    return entries
 
 # Connect to your PostgreSQL DB
 conn = psycopg2.connect(
@@ -23,6 +62,13 @@ cur.execute("SELECT COALESCE(MAX(execution_datetime), '1900-01-01') FROM t_proce
 latest_execution_datetime = cur.fetchone()[0]
 print(f"Latest execution datetime : {latest_execution_datetime}")
 
+# Load the log entries
+if LOG_SOURCE == "s3":
+    data = load_s3_log_entries(str(latest_execution_datetime)[:10])
+else:
+    with open(LOG_FILE) as file:
+        data = json.load(file)
+
 # Track duplicates and processed records
 duplicate_entries = []
 processed_entries = []
@@ -34,7 +80,7 @@ for entry in data:
 
     # Extract record_filenumber using regex pattern
     # pattern = r"\/([^\/]+?)(?:_|\.)"
-    pattern = r"\/([^\/]+)(?:_embeddings\.json|_structured\.txt|_cleaned\.json|\.pdf)$"
+    pattern = r"\/([^\/]+)(?:_embeddings\.json|_structured\.txt|_structured\.json|_cleaned\.json|\.pdf)$"
     match = re.search(pattern, file_path)
     record_filenumber = match.group(1) if match else None
     record_filenumber = record_filenumber+".pdf"
@@ -2,10 +2,13 @@ import json
 import urllib.parse
 import time
 import os
+import uuid
 import re
 import boto3
 from datetime import datetime
 from botocore.exceptions import ClientError
+from textract_results import (S3MultipartWriter, backoff_settings, iter_textract_pages,
+                              iter_textract_results, new_fetch_stats, stream_textract_blocks)
 # Initialize boto3 clients for Textract and S3
 textract = boto3.client('textract')
 s3 = boto3.client('s3')
@@ -73,23 +76,15 @@ def lambda_handler(event, context):
                     
                 else:
                     print(f'Lambda processing')
-                    # Call Textract to get the job results
-                    all_results = get_all_results(job_id)
-                    #Merge all the results in one Json file
-                    result_json = merge_results(all_results)
-                    
-                    # Define the S3 bucket and object key for storing results
-                    
-                    
                     #Add Job_id into metadata of the json file that will be stored in S3
                     metadata = {'AWS Textract jobid': f'{job_id}'}
                    
-                    # Upload the AWS TExtract json output results to S3 
-                    s3_put_object(output_bucket,output_key,result_json,metadata)
+                    # Stream the AWS TExtract json output results to S3, converting them page by page on the way
+                    structured_output, simple_text, page_number = stream_and_convert_results(
+                        job_id, output_bucket, output_key, metadata, enable_simple_text_file == '1')
                     
                     #If the json data needed to convert into structured text file   
                     if enable_structured_data == '1':
-                        structured_output, page_number = extract_text_from_textract_withoutsection(json.loads(result_json))
                         
                         #key_to_find_coversheet = cached_config.get('coversheet_text')
                         #coversheet_instance_count = count_text_across_pages(structured_output, key_to_find_coversheet) 
@@ -99,9 +94,14 @@ def lambda_handler(event, context):
                         structured_data_folder = cached_config.get('ocr_structured_data_folder')
                         structured_data_suffix = cached_config.get('ocr_structured_data_suffix')
                         
-                        cleanpdf_output_key = f'{structured_data_folder}{filename_without_extension}{structured_data_suffix}.txt'
+                        #"json": {page: {text_lines, kv, tables}} in a .json file, "text": the legacy quoted text file, as the
+                        #structured-output generator writes; output_string stays the text rendering for chunking and key lookups
+                        output_format = cached_config.get('ocr_structured_output_format', 'text')
+                        output_extension = 'json' if output_format == 'json' else 'txt'
+                        cleanpdf_output_key = f'{structured_data_folder}{filename_without_extension}{structured_data_suffix}.{output_extension}'
+                        structured_body = build_output_json_withoutsection(structured_output) if output_format == 'json' else output_string
                         # Upload the results to S3
-                        s3_put_object(output_bucket,cleanpdf_output_key,output_string,'')
+                        s3_put_object(output_bucket,cleanpdf_output_key,structured_body,'')
                     
                     #Perform data chunking on the structured data
                     build_segmented_data(output_string,filename_without_extension,output_bucket)
@@ -109,7 +109,7 @@ def lambda_handler(event, context):
                     #Convert Json results into simple text file (Not the strucutred one)
                     if enable_simple_text_file == '1':
                         #Transform json into simple text file 
-                        formatted_text = extract_text_from_textract(json.loads(result_json))
+                        formatted_text = simple_text
                          
                         simple_text_input = json.dumps({"text": formatted_text})
                         
@@ -173,32 +173,37 @@ def lambda_handler(event, context):
         }
 
 
-#Get all the results from AWS Textract output from multiple json responses
-def get_all_results(job_id):
-    all_results = []
-    response = textract.get_document_analysis(JobId=job_id)
-    all_results.extend(response['Blocks'])
-
-    while 'NextToken' in response:
-        next_token = response['NextToken']
-        response = textract.get_document_analysis(JobId=job_id, NextToken=next_token)
-        all_results.extend(response['Blocks'])
-    
-    return all_results
-
-#Merge all the json responses from AWS Textract
-def merge_results(all_results):
-    return json.dumps({'Blocks': all_results})
+#Stream the analysis results into S3 as {"Blocks": [...]} (the file json.dumps of all the blocks produced) and
+#convert them page by page as they arrive, so only the unfinished pages are held in memory
+#Returns the structured output, the simple text per page (when with_simple_text) and the last page number
+def stream_and_convert_results(job_id, bucket_name, file_key, metadata, with_simple_text):
+    stats = new_fetch_stats()
+    structured_output, simple_text, page_number = {}, {}, 0
+    writer = S3MultipartWriter(s3, bucket_name, file_key, metadata)
+    try:
+        responses = iter_textract_results(textract.get_document_analysis, job_id, stats, **backoff_settings(cached_config))
+        for page, page_blocks, block_by_id in iter_textract_pages(stream_textract_blocks(responses, writer, stats)):
+            page_content, page_number = extract_text_from_textract_withoutsection({'Blocks': page_blocks}, block_by_id)
+            structured_output.update(page_content)
+            if with_simple_text:
+                simple_text.update(extract_text_from_textract({'Blocks': page_blocks}, block_by_id))
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    print(f"Textract results fetched: pages {stats['pages']}, blocks {stats['blocks']}, retries {stats['retries']}, throttle wait {stats['throttle_wait_seconds']:.2f}s")
+    return structured_output, simple_text, page_number
 
 #Convert json output to simple text file
-def extract_text_from_textract(textract_json):
+def extract_text_from_textract(textract_json, block_by_id=None):
     blocks = textract_json.get('Blocks', [])
     
     # Dictionary to store text per page
     page_text = {}
     
     # Store blocks by their ID for faster lookup (especially for TABLEs)
-    block_by_id = {block['Id']: block for block in blocks}
+    if block_by_id is None:
+        block_by_id = {block['Id']: block for block in blocks}
 
     for block in blocks:
         block_type = block.get('BlockType')
@@ -276,14 +281,17 @@ def s3_get_object_Json(bucket_name,file_key):
     return log_data   
 
 #Extract the textract json data into Structured format Page -> Text, Key-value pairs, Tables
-def extract_text_from_textract_withoutsection(textract_json):
+def extract_text_from_textract_withoutsection(textract_json, block_by_id=None):
     blocks = textract_json.get('Blocks', [])
     
     # Dictionaries to store structured data for each page
     page_content = {}
+    # Keys of the key-value pairs of each page, kept in step with page_content so LINE blocks are checked in O(1)
+    kv_keys = {}
     
     # Store blocks by their ID for faster lookup
-    block_by_id = {block['Id']: block for block in blocks}
+    if block_by_id is None:
+        block_by_id = {block['Id']: block for block in blocks}
 
     for block in blocks:
         block_type = block.get('BlockType')
@@ -296,6 +304,7 @@ def extract_text_from_textract_withoutsection(textract_json):
                 'text': [],
                 'tables': []
             }
+            kv_keys[page_number] = set()
 
         # Handle KEY_VALUE_SET blocks (Form extraction)
         if block_type == 'KEY_VALUE_SET':
@@ -305,13 +314,14 @@ def extract_text_from_textract_withoutsection(textract_json):
                 key = key.replace(':','')
             if key != '' or value != '':
                 page_content[page_number]['KeyValuePairs'].append({key: value})
+                kv_keys[page_number].add(key)
           
             
         # Handle LINE blocks (Text extraction)
         elif block_type == 'LINE':
             text_value = block.get('Text', '')
             # Only add if it doesn't already exist in key-value pairs or tables
-            if not any(text_value in kv for kv in page_content[page_number]['KeyValuePairs']):
+            if text_value not in kv_keys[page_number]:
                 page_content[page_number]['text'].append(text_value)
 
         # Handle TABLE blocks (Table extraction)
@@ -428,9 +438,11 @@ def build_output_string_withoutsection(output):
             output_string.append(f"  Tables:\n")
             for table_index, table_data in enumerate(content['tables'], start=1):
                 output_string.append(f"    Table {table_index}:\n")
-                output_string.append(f"      Column Header: {', '.join(table_data['Column Header']).replace('\\','/').replace('"', '\\"')}\n")
+                column_header = ', '.join(table_data['Column Header']).replace('\\','/').replace('"', '\\"')
+                output_string.append(f"      Column Header: {column_header}\n")
                 for row_index, row in enumerate(table_data['Rows'], start=1):
-                    output_string.append(f"      Row{row_index}: {', '.join(row).replace('\\','/').replace('"', '\\"')}\n")
+                    row_v = ', '.join(row).replace('\\','/').replace('"', '\\"')
+                    output_string.append(f"      Row{row_index}: {row_v}\n")
         
         
         if page == total_pages:
@@ -441,6 +453,20 @@ def build_output_string_withoutsection(output):
     output_string.append(f'}}')
     return ''.join(output_string)
 
+#Build the structured output as real JSON: {"1": {"text_lines": [...], "kv": [...], "tables": [...]}, ...}
+def build_output_json_withoutsection(output):
+    pages = [build_page_json_withoutsection(page, content) for page, content in output.items()]
+    return '{' + ',\n'.join(pages) + '\n}' if pages else '{}'
+
+#Build the JSON member ("page": {...}) of a single page
+def build_page_json_withoutsection(page, content):
+    page_json = {
+        'text_lines': content.get('text', []),
+        'kv': [{'key': key.strip(), 'value': value.strip()} for kvp in content.get('KeyValuePairs', []) for key, value in kvp.items()],
+        'tables': [{'column_header': table['Column Header'], 'rows': table['Rows']} for table in content.get('tables', [])]
+    }
+    return f'{json.dumps(str(page))}: {json.dumps(page_json, ensure_ascii=False)}'
+
 #Chunk data from the larger files in smaller one based on 10000 char limit.
 def chunk_text_by_page(text, page_marker='"Page', char_limit=10000):
     chunks = []
@@ -537,6 +563,11 @@ def create_update_log_file(bucket_name,object_key, page_number):
         "message": logfile_status_message
     }
     
+    # Append-only when "ocr_processlog_format" is "ndjson": one small NDJSON object per event, partitioned by date/hour
+    if cached_config.get('ocr_processlog_format', 'json-array') == 'ndjson':
+        append_log_event(bucket_name, body, cached_config)
+        return "success"
+
     #print(f'bucket name : {bucket_name}, object key: {new_object_key}, body: {body}')
     #Check if object exists already then update it or create new object 
     object_exists = check_if_object_exists(bucket_name,new_object_key)
@@ -550,6 +581,14 @@ def create_update_log_file(bucket_name,object_key, page_number):
     s3_put_object(bucket_name,new_object_key,json.dumps(log_data),'')
     return "success"
 
+#Write one log event as its own NDJSON object under a date/hour partition (no read-modify-write)
+def append_log_event(bucket_name, body, config):
+    events_prefix = config.get('ocr_processlog_events_prefix', 'logs/events/')
+    now = datetime.now()
+    event_key = f"{events_prefix}dt={now.strftime('%Y-%m-%d')}/hr={now.strftime('%H')}/{now.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:12]}.ndjson"
+    s3.put_object(Bucket=bucket_name, Key=event_key, Body=json.dumps(body) + '\n', ContentType='application/x-ndjson')
+    return event_key
+
 def check_if_object_exists(bucket, key):
     try:
         # Try to get metadata about the object
@@ -2,7 +2,13 @@ import boto3
 import json
 import os
 import re
+import threading
+import time
 import urllib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from textract_results import S3MultipartWriter
 
 s3 = boto3.client("s3")
 
@@ -19,6 +25,7 @@ def lambda_handler(event, context):
     cached_config = s3_get_object_Json(BUCKET_NAME,ocr_configpath)
     ocr_resultsfolder = cached_config.get('ocr_resultsfolder')
     ocr_results_suffix = cached_config.get('ocr_results_suffix')
+    merge_concurrency = int(cached_config.get('ocr_merge_concurrency', '4'))
     
     # Extract folder name dynamically (document-specific subfolder)
     folder_name = "/".join(input_s3_key.split("/")[:-1])  # "processed-json/sample_pdf"
@@ -32,101 +39,293 @@ def lambda_handler(event, context):
     pdf_file_key = urllib.parse.unquote_plus(pdf_file_key)
     document_name = urllib.parse.unquote_plus(document_name)
     
+    # Event-driven path: record this part once and merge exactly once, without listing the folder
+    tracker = get_split_tracker(cached_config)
+    if tracker is not None:
+        part_match = re.search(r"_part_(\d+)_ocrresults\.json", input_s3_key)
+        if part_match is None:
+            return {"message": f"Not a split part: {input_s3_key}"}
+        part_number = int(part_match.group(1))
+        # The split PDF carries its split run and that run's part count; tracking is scoped per run,
+        # so a document uploaded or split again (possibly into a different number of parts) merges again
+        metadata = s3.head_object(Bucket=BUCKET_NAME, Key=pdf_file_key)["Metadata"]
+        total_p = int(metadata.get("total_p", "1"))
+        split_run = metadata.get("split_run")
+        split_id = f"{document_name}#{split_run}" if split_run else document_name
+        status, received, total_splits = tracker.record_part(split_id, part_number, lambda: total_p)
+        print(f"Part {part_number} of {split_id}: {status} ({received}/{total_splits})")
+
+        if status == "merge":
+            try:
+                merged_json_key = merge_json_files(BUCKET_NAME, folder_name, document_name, ocr_resultsfolder, ocr_results_suffix, merge_concurrency, total_splits)
+            except Exception:
+                tracker.release_merge(split_id)
+                raise
+            tracker.mark_merged(split_id)
+            return {"message": f"Merged JSON stored at {merged_json_key}"}
+        messages = {"waiting": "Waiting for more JSON files", "duplicate": "Duplicate part event ignored", "merging": "Merge already claimed"}
+        return {"message": messages[status], "received_parts": received}
+
     # Retrieve total expected splits from metadata
     metadata = s3.head_object(Bucket=BUCKET_NAME, Key=pdf_file_key)["Metadata"]
     
     total_splits = int(metadata.get("total_p", "1"))
     print(f"total_splits: {total_splits}")
     # List all JSON files in the same document folder
-    response = s3.list_objects_v2(Bucket=BUCKET_NAME, Prefix=folder_name)
-    
-    json_files = [obj["Key"] for obj in response.get("Contents", []) if obj["Key"].endswith(".json")]
+    json_files = [key for key in list_keys(BUCKET_NAME, folder_name) if key.endswith(".json")]
     print(f"extracted Parts: {json_files}")
 
-    # Extract part numbers from filenames (e.g., "split_1.json" → 1)
+    # Extract part numbers from filenames (e.g., "split_1.json" → 1); parts beyond total_p are left over
+    # from an earlier split of the same document into more parts
     extracted_parts = sorted(
-        [int(re.search(r"_part_(\d+)_ocrresults\.json", key).group(1)) for key in json_files]
+        [part for part in (int(re.search(r"_part_(\d+)_ocrresults\.json", key).group(1)) for key in json_files) if part <= total_splits]
     )
 
     # Check if we have all expected parts
     if len(extracted_parts) == total_splits and sorted(extracted_parts) == list(range(1, total_splits + 1)):
         print(f"All {total_splits} parts received for {document_name}. Merging...")
-        merged_json_key = merge_json_files(BUCKET_NAME, folder_name, document_name, ocr_resultsfolder, ocr_results_suffix)
+        merged_json_key = merge_json_files(BUCKET_NAME, folder_name, document_name, ocr_resultsfolder, ocr_results_suffix, merge_concurrency, total_splits)
         return {"message": f"Merged JSON stored at {merged_json_key}"}
 
     return {"message": "Waiting for more JSON files", "received_parts": len(extracted_parts)}
 
 #Merge all splitted files into one single ocr file
-def merge_json_files(bucket_name, folder_prefix, document_name,ocr_resultsfolder,ocr_results_suffix):
+def merge_json_files(bucket_name, folder_prefix, document_name,ocr_resultsfolder,ocr_results_suffix,max_in_flight=4,total_splits=None):
     """
     Merges extracted JSONs once all splits are available.
+    Parts are downloaded concurrently (at most max_in_flight at a time) and written out in part
+    order as they complete, so only a few parts are held in memory at once.
+    Only parts 1..total_splits are merged when total_splits is given.
     """
-    response = s3.list_objects_v2(Bucket=bucket_name, Prefix=folder_prefix)
     print(f"All Splits are available")
+    part_of = lambda key: int(re.search(r"_part_(\d+)_ocrresults\.json", key).group(1))
     # Get JSON files and sort them based on part number in filename
     json_files = sorted(
-        [obj["Key"] for obj in response.get("Contents", []) if obj["Key"].endswith(".json")],
-        key=lambda x: int(re.search(r"_part_(\d+)_ocrresults\.json", x).group(1))
+        [key for key in list_keys(bucket_name, folder_prefix) if key.endswith(".json")],
+        key=part_of
     )
+    if total_splits is not None:
+        json_files = [key for key in json_files if part_of(key) <= total_splits]
     print(f"Json_file: {json_files}")
    
     
-    merged_blocks = []
-    page_offset = 0
-
-    for json_file in json_files:
-        print(f"Processing: {json_file}")
-        obj = s3.get_object(Bucket=bucket_name, Key=json_file)
-        textract_data = json.loads(obj["Body"].read().decode("utf-8"))
-
-        blocks = textract_data.get("Blocks", [])
-        part_page_count = sum(1 for block in blocks if block["BlockType"] == "PAGE")
-        
-        
-        """
-        Optimized code to adjust page numbers and handle relationships efficiently.
-        """
-    
-        # Step 1: Create a dictionary for fast lookups of blocks by "Id"
-        block_map = {block["Id"]: block for block in merged_blocks}
-    
-        # Step 2: Process blocks and adjust page numbers
-        for block in blocks:
-            # Adjust page numbers for blocks that have a "Page" key
-            if "Page" in block:
-                block["Page"] += page_offset
-    
-            # Step 3: Handle relationships for child blocks (key-value pairs, cells in tables)
-            if "Relationships" in block:
-                for rel in block["Relationships"]:
-                    if rel["Type"] == "CHILD":
-                        for sub_block_id in rel["Ids"]:
-                            # Use the block_map for fast lookup of child blocks
-                            merged_block = block_map.get(sub_block_id)
-                            if merged_block and "Page" in merged_block:
-                                merged_block["Page"] += page_offset
-    
-            # Append block to merged list
-            merged_blocks.append(block)
-        
-        page_offset += part_page_count
-
-    # Prepare the final merged JSON structure
-    merged_json = {
-        "DocumentMetadata": {
-            "Pages": page_offset
-        },
-        "Blocks": merged_blocks
-    }
-    
-    # Save merged JSON to S3
+    # Save merged JSON to S3, streamed part by part in part order
     final_json_key = f"{ocr_resultsfolder}{document_name}{ocr_results_suffix}.json"
     print(f"final_json_key: {final_json_key}")
-    s3.put_object(Bucket=bucket_name, Key=final_json_key, Body=json.dumps(merged_json))
+
+    writer = S3MultipartWriter(s3, bucket_name, final_json_key)
+    page_offset = 0
+    blocks_written = 0
+    try:
+        # "Blocks" comes first so blocks can be written before the total page count is known
+        writer.write('{"Blocks": [')
+        for json_file, textract_data in fetch_parts_in_order(bucket_name, json_files, max_in_flight):
+            print(f"Processing: {json_file}")
+            blocks = textract_data.get("Blocks", [])
+
+            # Shift this part's page numbers past all earlier parts, in one pass
+            part_page_count = 0
+            for block in blocks:
+                if block["BlockType"] == "PAGE":
+                    part_page_count += 1
+                if "Page" in block:
+                    block["Page"] += page_offset
+
+            if blocks:
+                if blocks_written:
+                    writer.write(', ')
+                writer.write(json.dumps(blocks)[1:-1])
+                blocks_written += len(blocks)
+            page_offset += part_page_count
+
+        writer.write(f'], "DocumentMetadata": {{"Pages": {page_offset}}}}}')
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
 
     print(f"Merged JSON saved to {final_json_key}")
     return final_json_key
 
+#Download and parse parts concurrently, yielding them in the given order; at most max_in_flight
+#parts are fetched or waiting to be consumed at any time
+def fetch_parts_in_order(bucket_name, keys, max_in_flight=4):
+    def fetch(key):
+        obj = s3.get_object(Bucket=bucket_name, Key=key)
+        return json.loads(obj["Body"].read().decode("utf-8"))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as pool:
+        in_flight = deque()
+        keys = iter(keys)
+        for key in keys:
+            in_flight.append((key, pool.submit(fetch, key)))
+            if len(in_flight) >= max_in_flight:
+                break
+        while in_flight:
+            key, future = in_flight.popleft()
+            textract_data = future.result()
+            next_key = next(keys, None)
+            if next_key is not None:
+                in_flight.append((next_key, pool.submit(fetch, next_key)))
+            yield key, textract_data
+
+#List every key under a prefix (list_objects_v2 returns at most 1000 per call)
+def list_keys(bucket_name, prefix):
+    keys = []
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys.extend(obj["Key"] for obj in page.get("Contents", []))
+    return keys
+
+#Split-completion tracking: each part is recorded exactly once, and only the arrival that brings the
+#count to total_p is told to merge. Backends: DynamoDB (conditional writes) and an in-memory stand-in
+class DynamoDBSplitTracker:
+    """
+    Table with a string partition key "pk" (document name and split run) and sort key "sk": one
+    "part#<n>" item per received part, and one "status" item holding total, received, merge_state and
+    claimed_at. A part is stored and counted in one transaction, so a duplicate S3 event is a no-op and
+    no part is stored without being counted. Exactly one invocation claims the merge; the claim is a
+    lease that another invocation may take over once lease_seconds (the Lambda timeout) have passed,
+    so a merge killed by a timeout is retried. Every item carries an "expires_at" TTL attribute.
+    """
+    def __init__(self, table_name, ttl_seconds=7 * 86400, lease_seconds=900):
+        self.dynamodb = boto3.client("dynamodb")
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+
+    def _key(self, document, sort_key):
+        return {"pk": {"S": document}, "sk": {"S": sort_key}}
+
+    def _expires_at(self):
+        return {"N": str(int(time.time()) + self.ttl_seconds)}
+
+    def _is_conditional_failure(self, e):
+        return e.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+    def record_part(self, document, part_number, get_total):
+        # 1. Store and count the part in one transaction (the first part also stores total_p)
+        try:
+            self.dynamodb.transact_write_items(TransactItems=[
+                {"Put": {
+                    "TableName": self.table_name,
+                    "Item": {**self._key(document, f"part#{part_number}"), "expires_at": self._expires_at()},
+                    "ConditionExpression": "attribute_not_exists(pk)"
+                }},
+                {"Update": {
+                    "TableName": self.table_name,
+                    "Key": self._key(document, "status"),
+                    "UpdateExpression": "ADD #received :one SET #total = if_not_exists(#total, :total), "
+                                        "expires_at = if_not_exists(expires_at, :expires_at)",
+                    "ExpressionAttributeNames": {"#received": "received", "#total": "total"},
+                    "ExpressionAttributeValues": {":one": {"N": "1"}, ":total": {"N": str(get_total())},
+                                                  ":expires_at": self._expires_at()}
+                }}
+            ])
+            is_new = True
+        except ClientError as e:
+            reasons = e.response.get("CancellationReasons", [])
+            if e.response["Error"]["Code"] != "TransactionCanceledException" or not reasons or reasons[0].get("Code") != "ConditionalCheckFailed":
+                raise
+            is_new = False
+
+        # 2. Read the counts; a redelivered part may still claim a merge that never started or timed out
+        status = self.dynamodb.get_item(
+            TableName=self.table_name, Key=self._key(document, "status"), ConsistentRead=True
+        ).get("Item", {})
+        received = int(status.get("received", {"N": "0"})["N"])
+        total = int(status["total"]["N"]) if "total" in status else None
+        if total is None or received < total:
+            return ("waiting" if is_new else "duplicate"), received, total
+
+        # 3. Claim the merge: free, or started by an invocation whose lease has expired
+        now = int(time.time())
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(document, "status"),
+                UpdateExpression="SET merge_state = :started, claimed_at = :now",
+                ConditionExpression="attribute_not_exists(merge_state) OR (merge_state = :started AND "
+                                    "(attribute_not_exists(claimed_at) OR claimed_at < :stale))",
+                ExpressionAttributeValues={":started": {"S": "started"}, ":now": {"N": str(now)},
+                                           ":stale": {"N": str(now - self.lease_seconds)}}
+            )
+        except ClientError as e:
+            if self._is_conditional_failure(e):
+                return "merging", received, total
+            raise
+        return "merge", received, total
+
+    def mark_merged(self, document):
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key=self._key(document, "status"),
+            UpdateExpression="SET merge_state = :merged REMOVE claimed_at",
+            ExpressionAttributeValues={":merged": {"S": "merged"}}
+        )
+
+    def release_merge(self, document):
+        # A failed merge gives up its claim, so the retried event can merge again
+        self.dynamodb.update_item(
+            TableName=self.table_name,
+            Key=self._key(document, "status"),
+            UpdateExpression="REMOVE merge_state, claimed_at"
+        )
+
+class InMemorySplitTracker:
+    """Stand-in for local testing: same contract as DynamoDBSplitTracker, state lives in this process."""
+    def __init__(self, lease_seconds=900):
+        self.lock = threading.Lock()
+        self.parts = set()
+        self.status = {}
+        self.lease_seconds = lease_seconds
+
+    def record_part(self, document, part_number, get_total):
+        with self.lock:
+            is_new = (document, part_number) not in self.parts
+            status = self.status.setdefault(document, {"received": 0, "total": get_total()})
+            if is_new:
+                self.parts.add((document, part_number))
+                status["received"] += 1
+            if status["received"] < status["total"]:
+                return ("waiting" if is_new else "duplicate"), status["received"], status["total"]
+            now = time.time()
+            if status.get("merge_state") == "merged" or (
+                    status.get("merge_state") == "started" and status["claimed_at"] >= now - self.lease_seconds):
+                return "merging", status["received"], status["total"]
+            status["merge_state"], status["claimed_at"] = "started", now
+            return "merge", status["received"], status["total"]
+
+    def mark_merged(self, document):
+        with self.lock:
+            self.status[document]["merge_state"] = "merged"
+            self.status[document].pop("claimed_at", None)
+
+    def release_merge(self, document):
+        with self.lock:
+            self.status[document].pop("merge_state", None)
+            self.status[document].pop("claimed_at", None)
+
+_split_tracker = None
+
+#Tracker selected by config "ocr_split_tracker": "dynamodb", "memory", or "listing" (legacy folder listing)
+def get_split_tracker(config):
+    global _split_tracker
+    backend = config.get("ocr_split_tracker", "listing")
+    if backend == "listing":
+        return None
+    if _split_tracker is None:
+        # A merge claim older than the Lambda timeout belongs to an invocation that was killed
+        lease_seconds = int(config.get("ocr_merge_lease_seconds", "900"))
+        if backend == "dynamodb":
+            ttl_days = int(config.get("ocr_split_tracker_ttl_days", "7"))
+            _split_tracker = DynamoDBSplitTracker(config.get("ocr_split_tracker_table"), ttl_days * 86400, lease_seconds)
+        elif backend == "memory":
+            _split_tracker = InMemorySplitTracker(lease_seconds)
+        else:
+            raise ValueError(f"Unknown ocr_split_tracker backend: {backend}")
+    return _split_tracker
+
 def s3_get_object_Json(bucket_name,file_key):
     response = s3.get_object(Bucket=bucket_name, Key=file_key)
     log_data = json.loads(response['Body'].read().decode('utf-8'))
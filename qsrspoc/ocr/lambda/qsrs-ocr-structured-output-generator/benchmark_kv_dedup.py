@@ -0,0 +1,99 @@
+"""
+Benchmarks the LINE vs key-value de-duplication of extract_text_from_textract_withoutsection on
+synthetic form pages, and checks it keeps the text lines the previous list scan kept.
+
+Each page holds N key-value pairs, interleaved with LINE blocks of which half repeat a key.
+The previous check scanned every pair of the page for each LINE (O(N^2) per page); the per-page
+key set makes it O(N), so the time per pair should stay flat as N grows.
+
+Usage:
+    python benchmark_kv_dedup.py [--pairs 250 500 1000 2000 4000] [--pages 5] [--repeat 3]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+# The Lambda module creates its boto3 clients at import; no call is made
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# textract_results comes from the textract-results layer (/opt/python in Lambda)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'layers', 'textract-results', 'python'))
+spec = importlib.util.spec_from_file_location(
+    'structured_output_generator',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qsrs-ocr-structured-output-generator.py'))
+generator = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(generator)
+
+def build_form_pages(pages, pairs):
+    # Textract-shaped blocks: per pair a KEY and VALUE set with one WORD each, plus two LINEs
+    blocks = []
+    for page in range(1, pages + 1):
+        blocks.append({'BlockType': 'PAGE', 'Id': f'p{page}', 'Page': page})
+        for i in range(pairs):
+            prefix = f'p{page}-{i}'
+            blocks.append({'BlockType': 'KEY_VALUE_SET', 'Id': f'{prefix}-k', 'Page': page, 'EntityTypes': ['KEY'],
+                           'Relationships': [{'Type': 'CHILD', 'Ids': [f'{prefix}-kw']}, {'Type': 'VALUE', 'Ids': [f'{prefix}-v']}]})
+            blocks.append({'BlockType': 'KEY_VALUE_SET', 'Id': f'{prefix}-v', 'Page': page, 'EntityTypes': ['VALUE'],
+                           'Relationships': [{'Type': 'CHILD', 'Ids': [f'{prefix}-vw']}]})
+            blocks.append({'BlockType': 'WORD', 'Id': f'{prefix}-kw', 'Page': page, 'Text': f'Field {i}'})
+            blocks.append({'BlockType': 'WORD', 'Id': f'{prefix}-vw', 'Page': page, 'Text': f'value {i}'})
+            # Key text as extracted (words joined with a trailing space), so this LINE is de-duplicated
+            blocks.append({'BlockType': 'LINE', 'Id': f'{prefix}-l1', 'Page': page, 'Text': f'Field {i} '})
+            blocks.append({'BlockType': 'LINE', 'Id': f'{prefix}-l2', 'Page': page, 'Text': f'Note {i}'})
+    return {'Blocks': blocks}
+
+def list_scan_text_lines(document):
+    # Reference: the previous check, any(text in kv for kv in pairs) for each LINE, on the same pairs
+    store = generator.TextractBlockStore(document['Blocks'])
+    key_value_set, line = store.type_code('KEY_VALUE_SET'), store.type_code('LINE')
+    pairs, text = {}, {}
+    start = time.perf_counter()
+    for i in range(store.size):
+        page = store.pages[i]
+        pairs.setdefault(page, [])
+        text.setdefault(page, [])
+        if store.types[i] == key_value_set:
+            key, value = generator.extract_key_value_pair(store, i)
+            if key != '' or value != '':
+                pairs[page].append({key: value})
+        elif store.types[i] == line:
+            text_value = store.text(i)
+            if not any(text_value in kv for kv in pairs[page]):
+                text[page].append(text_value)
+    return text, time.perf_counter() - start
+
+def best_of(repeat, fn, *args):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def main():
+    parser = argparse.ArgumentParser(description='LINE vs key-value de-duplication benchmark')
+    parser.add_argument('--pairs', nargs='+', type=int, default=[250, 500, 1000, 2000, 4000])
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    report = []
+    for pairs in args.pairs:
+        document = build_form_pages(args.pages, pairs)
+        (page_content, _), seconds = best_of(args.repeat, generator.extract_text_from_textract_withoutsection, document)
+        (reference, scan_seconds), _ = best_of(1, list_scan_text_lines, document)
+        if any(page_content[page]['text'] != reference[page] for page in page_content):
+            raise SystemExit(f'{pairs} pairs: text lines differ from the list scan')
+        report.append({
+            'pairs_per_page': pairs,
+            'extract_seconds': round(seconds, 4),
+            'us_per_pair': round(seconds / (pairs * args.pages) * 1e6, 2),
+            'list_scan_seconds': round(scan_seconds, 4),
+        })
+        print(json.dumps(report[-1]))
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,15 @@ import json
 import urllib.parse
 import time
 import os
+import uuid
 import re
+import codecs
 import boto3
+from array import array
+from itertools import accumulate
 from datetime import datetime
 from botocore.exceptions import ClientError
+from textract_results import S3MultipartWriter, iter_textract_pages
 # Initialize boto3 clients for Textract and S3
 textract = boto3.client('textract')
 s3 = boto3.client('s3')
@@ -47,22 +52,34 @@ def lambda_handler(event, context):
         pdf_filename = urllib.parse.unquote_plus(pdf_filename)
         output_key = urllib.parse.unquote_plus(output_key)
         
-        result_json = s3_get_object_Json(output_bucket, input_s3_key)
-        
         #Get Global variables and Environment variable values 
         cached_config = s3_get_object_Json(output_bucket,ocr_configpath)
        
-        #json data to convert into structured text file   
-        structured_output, page_number = extract_text_from_textract_withoutsection(result_json)
-        
-        output_string = build_output_string_withoutsection(structured_output)
         #structured_data_folder = os.getenv('ocr_structured_data_folder')
         structured_data_folder = cached_config.get('ocr_structured_data_folder')
         structured_data_suffix = cached_config.get('ocr_structured_data_suffix')
         filename_without_extension = filename_without_extension.replace("_ocrresults", "")
-        cleanpdf_output_key = f'{structured_data_folder}{filename_without_extension}{structured_data_suffix}.txt'
-        # Upload the results to S3
-        s3_put_object(output_bucket,cleanpdf_output_key,output_string,'')
+        #"json": {page: {text_lines, kv, tables}} in a .json file, "text": the legacy quoted text file
+        output_format = cached_config.get('ocr_structured_output_format', 'text')
+        output_extension = 'json' if output_format == 'json' else 'txt'
+        cleanpdf_output_key = f'{structured_data_folder}{filename_without_extension}{structured_data_suffix}.{output_extension}'
+
+        if cached_config.get('ocr_structured_streaming', '1') == '1':
+            #Stream the Textract json page by page into the structured text file (memory bounded by the largest page)
+            page_number = stream_structured_output(output_bucket, input_s3_key, cleanpdf_output_key, output_format)
+        else:
+            #Load the Textract json into the compact block store; the parsed blocks are released once it is built
+            store = TextractBlockStore(s3_get_object_Json(output_bucket, input_s3_key).get('Blocks', []))
+
+            #json data to convert into structured text file   
+            structured_output, page_number = extract_text_from_block_store(store)
+            
+            if output_format == 'json':
+                output_string = build_output_json_withoutsection(structured_output)
+            else:
+                output_string = build_output_string_withoutsection(structured_output)
+            # Upload the results to S3
+            s3_put_object(output_bucket,cleanpdf_output_key,output_string,'')
         
         #Once processing is complete, publish to SNS
         custom_payload = {
@@ -113,19 +130,109 @@ def s3_get_object_Json(bucket_name,file_key):
     log_data = json.loads(response['Body'].read().decode('utf-8'))
     return log_data   
 
+#Compact, array based copy of the Textract blocks the extraction needs: block type, page, row/column
+#index, KEY entity flag and text (offsets into one string buffer), with CHILD and VALUE relationships
+#stored CSR style (the targets of block i are targets[offsets[i]:offsets[i + 1]], as block indexes)
+class TextractBlockStore:
+
+    def __init__(self, blocks, block_by_id=None):
+        self.type_codes = {}  # BlockType -> small int code, in first-seen order
+        index = {}  # block Id -> block index, only needed while building
+        types, pages, rows, columns, is_key, texts = [], [], [], [], [], []
+        raw_children, child_ends = [], []
+        raw_values, value_ends = [], []
+
+        def add(block):
+            index[block['Id']] = len(types)
+            types.append(self.type_codes.setdefault(block.get('BlockType'), len(self.type_codes)))
+            pages.append(block.get('Page', 1))
+            rows.append(block.get('RowIndex', 0))
+            columns.append(block.get('ColumnIndex', 0))
+            is_key.append('KEY' in block.get('EntityTypes', ()))
+            texts.append(block.get('Text', ''))
+            for rel in block.get('Relationships', ()):
+                if rel.get('Type') == 'CHILD':
+                    raw_children.extend(rel.get('Ids', ()))
+                elif rel.get('Type') == 'VALUE':
+                    raw_values.extend(rel.get('Ids', ()))
+            child_ends.append(len(raw_children))
+            value_ends.append(len(raw_values))
+
+        # One pass over the blocks; their position is their index
+        for block in blocks:
+            add(block)
+        self.size = len(types)
+
+        # Blocks referenced from another page (streaming path) are added after them from block_by_id
+        if block_by_id is not None:
+            cursors = [0, 0]
+            added = True
+            while added:
+                added = False
+                for k, raw_ids in enumerate((raw_children, raw_values)):
+                    while cursors[k] < len(raw_ids):
+                        block_id = raw_ids[cursors[k]]
+                        cursors[k] += 1
+                        if block_id not in index and block_id in block_by_id:
+                            add(block_by_id[block_id])
+                            added = True
+
+        self.types = array('b', types)
+        self.pages = array('i', pages)
+        self.rows = array('i', rows)
+        self.columns = array('i', columns)
+        self.is_key = array('b', is_key)
+        self.text_offsets = array('q', accumulate(map(len, texts), initial=0))
+        self.text_buffer = ''.join(texts)
+        self.child_offsets, self.child_targets = self._resolve(raw_children, child_ends, index)
+        self.value_offsets, self.value_targets = self._resolve(raw_values, value_ends, index)
+
+    @staticmethod
+    def _resolve(raw_ids, ends, index):
+        # Block Ids -> block indexes; Ids of blocks that are not in the store are dropped
+        if all(block_id in index for block_id in raw_ids):
+            return array('q', [0] + ends), array('i', map(index.__getitem__, raw_ids))
+        offsets = array('q', [0])
+        targets = array('i')
+        start = 0
+        for end in ends:
+            targets.extend(index[block_id] for block_id in raw_ids[start:end] if block_id in index)
+            offsets.append(len(targets))
+            start = end
+        return offsets, targets
+
+    def type_code(self, block_type):
+        # -1 when the type never occurs, so comparisons simply never match
+        return self.type_codes.get(block_type, -1)
+
+    def text(self, i):
+        return self.text_buffer[self.text_offsets[i]:self.text_offsets[i + 1]]
+
+    def children(self, i):
+        return self.child_targets[self.child_offsets[i]:self.child_offsets[i + 1]]
+
+    def values(self, i):
+        return self.value_targets[self.value_offsets[i]:self.value_offsets[i + 1]]
+
 #Extract the textract json data into Structured format Page -> Text, Key-value pairs, Tables
-def extract_text_from_textract_withoutsection(textract_json):
-    blocks = textract_json.get('Blocks', [])
-    
+def extract_text_from_textract_withoutsection(textract_json, block_by_id=None):
+    # block_by_id: blocks referenced from outside textract_json (streaming path)
+    return extract_text_from_block_store(TextractBlockStore(textract_json.get('Blocks', []), block_by_id))
+
+#Same as extract_text_from_textract_withoutsection, on a TextractBlockStore
+def extract_text_from_block_store(store):
     # Dictionaries to store structured data for each page
     page_content = {}
-    
-    # Store blocks by their ID for faster lookup
-    block_by_id = {block['Id']: block for block in blocks}
+    # Keys of the key-value pairs of each page, kept in step with page_content so LINE blocks are checked in O(1)
+    kv_keys = {}
+    key_value_set = store.type_code('KEY_VALUE_SET')
+    line = store.type_code('LINE')
+    table = store.type_code('TABLE')
+
     page_number = 0
-    for block in blocks:
-        block_type = block.get('BlockType')
-        page_number = block.get('Page', 1)
+    for i in range(store.size):
+        block_type = store.types[i]
+        page_number = store.pages[i]
         
         # Initialize page entry if not already present
         if page_number not in page_content:
@@ -134,28 +241,29 @@ def extract_text_from_textract_withoutsection(textract_json):
                 'text': [],
                 'tables': []
             }
+            kv_keys[page_number] = set()
 
         # Handle KEY_VALUE_SET blocks (Form extraction)
-        if block_type == 'KEY_VALUE_SET':
-            key, value = extract_key_value_pair(block, block_by_id)
+        if block_type == key_value_set:
+            key, value = extract_key_value_pair(store, i)
             if key.strip().endswith(':'):
                 key = key.rstrip(':')
                 key = key.replace(':','')
             if key != '' or value != '':
                 page_content[page_number]['KeyValuePairs'].append({key: value})
+                kv_keys[page_number].add(key)
           
             
         # Handle LINE blocks (Text extraction)
-        elif block_type == 'LINE':
-            text_value = block.get('Text', '')
+        elif block_type == line:
+            text_value = store.text(i)
             # Only add if it doesn't already exist in key-value pairs or tables
-            if not any(text_value in kv for kv in page_content[page_number]['KeyValuePairs']):
+            if text_value not in kv_keys[page_number]:
                 page_content[page_number]['text'].append(text_value)
 
         # Handle TABLE blocks (Table extraction)
-        elif block_type == 'TABLE':
-            table_data = extract_table_data(block, block_by_id)
-            ##print(f'table_data {len(table_data)}')
+        elif block_type == table:
+            table_data = extract_table_data(store, i)
             # Avoid adding table content that is already in text or key-value pairs
             page_content[page_number]['tables'].append(table_data)
                     
@@ -164,75 +272,52 @@ def extract_text_from_textract_withoutsection(textract_json):
     return page_content, page_number
 
 #Extract Key-Value pairs from the file
-def extract_key_value_pair(block, block_by_id):
-    """Extract key-value pair from KEY_VALUE_SET block"""
+def extract_key_value_pair(store, i):
+    """Extract key-value pair from the KEY_VALUE_SET block at index i"""
     key = ""
     value = ""
+    word = store.type_code('WORD')
     
        # Check if the block is a key block
-    if 'KEY' in block['EntityTypes']:
+    if store.is_key[i]:
         # Extract the key text
-        if 'Relationships' in block:
-            for rel in block['Relationships']:
-                if rel['Type'] == 'CHILD':
-                    for child_id in rel['Ids']:
-                        key_block = block_by_id[child_id]
-                        if key_block['BlockType'] == 'WORD':
-                            key += key_block['Text'] + ' '
+        for child in store.children(i):
+            if store.types[child] == word:
+                key += store.text(child) + ' '
 
         # Extract the value text
-        if 'Relationships' in block:
-            for rel in block['Relationships']:
-                if rel['Type'] == 'VALUE':
-                    for value_id in rel['Ids']:
-                        value_block = block_by_id[value_id]
-                        if 'Relationships' in value_block:
-                            for val_rel in value_block['Relationships']:
-                                if val_rel['Type'] == 'CHILD':
-                                    for child_id in val_rel['Ids']:
-                                        word_block = block_by_id[child_id]
-                                        if word_block['BlockType'] == 'WORD':
-                                            value += word_block['Text'] + ' '
+        for value_block in store.values(i):
+            for child in store.children(value_block):
+                if store.types[child] == word:
+                    value += store.text(child) + ' '
 
     return key, value
 
 #Extract table data from the file
-def extract_table_data(table_block, block_by_id):
-    """Extract table data by traversing TABLE and CELL blocks"""
+def extract_table_data(store, i):
+    """Extract table data by traversing the TABLE block at index i and its CELL blocks"""
     table_data = {"Column Header": [], "Rows": []}
+    cell = store.type_code('CELL')
     
-    relationships = table_block.get('Relationships', [])
-    for relationship in relationships:
-        if relationship.get('Type') == 'CHILD':
-            child_ids = relationship.get('Ids', [])
-            for child_id in child_ids:
-                cell_block = block_by_id.get(child_id)
-                if cell_block and cell_block.get('BlockType') == 'CELL':
-                    cell_text = extract_text_from_cell(cell_block, block_by_id)
-                    row_index = cell_block.get('RowIndex', 0)
-                    col_index = cell_block.get('ColumnIndex', 0)
-                    
-                    if row_index == 1:
-                        table_data["Column Header"].append(cell_text)
-                    else:
-                        if len(table_data["Rows"]) < row_index - 1:
-                            table_data["Rows"].append([])
-                        table_data["Rows"][row_index - 2].append(cell_text)
+    for cell_block in store.children(i):
+        if store.types[cell_block] == cell:
+            cell_text = extract_text_from_cell(store, cell_block)
+            row_index = store.rows[cell_block]
+            
+            if row_index == 1:
+                table_data["Column Header"].append(cell_text)
+            else:
+                if len(table_data["Rows"]) < row_index - 1:
+                    table_data["Rows"].append([])
+                table_data["Rows"][row_index - 2].append(cell_text)
 
     return table_data
 
 #Extract cell data for tables from the file
-def extract_text_from_cell(cell_block, block_by_id):
-    """Extract text from a CELL block in a table"""
-    cell_text = []
-    if 'Relationships' in cell_block:
-        for rel in cell_block['Relationships']:
-            if rel.get('Type') == 'CHILD':
-                for grandchild_id in rel.get('Ids', []):
-                    child_block = block_by_id.get(grandchild_id)
-                    if child_block and child_block.get('BlockType') == 'WORD':
-                        cell_text.append(child_block.get('Text', ''))
-    return ' '.join(cell_text)
+def extract_text_from_cell(store, i):
+    """Extract text from the CELL block at index i"""
+    word = store.type_code('WORD')
+    return ' '.join(store.text(child) for child in store.children(i) if store.types[child] == word)
 
 
 
@@ -244,36 +329,7 @@ def build_output_string_withoutsection(output):
     total_pages = len(pages)
     output_string.append(f'{{')
     for page, content in output.items():
-        output_string.append(f'"Page {page}":"\n')
-        
-        # Add the text content for the page
-        if content.get('text'):
-            content_text = [text.replace('\\','/').replace('"', '\\"') for text in content['text']]
-            output_string.append(f"  Text: {', '.join(content_text)}\n")
-        else:
-            content_text = f"This page {page} is blank"  
-            output_string.append(f"  Text: {content_text}\n")
-        
-        # Add the key-value pairs for the page
-        if content.get('KeyValuePairs'):
-            output_string.append(f"  Key-Value Pairs:\n")
-            for kvp in content['KeyValuePairs']:
-                for key, value in kvp.items():
-                    content_key = key.replace('\\','/').replace('"','\\"')
-                    content_value = value.replace('\\','/').replace('"','\\"')
-                    output_string.append(f"    {content_key}: {content_value}\n")
-        
-        # Add the tables for the page
-        if content.get('tables'):
-            output_string.append(f"  Tables:\n")
-            for table_index, table_data in enumerate(content['tables'], start=1):
-                output_string.append(f"    Table {table_index}:\n")
-                column_header = ', '.join(table_data['Column Header']).replace('\\','/').replace('"', '\\"')
-                output_string.append(f"      Column Header: {column_header}\n")
-                for row_index, row in enumerate(table_data['Rows'], start=1):
-                    row_v = ', '.join(row).replace('\\','/').replace('"', '\\"')
-                    output_string.append(f"      Row{row_index}: {row_v}\n")
-        
+        output_string.append(build_page_string_withoutsection(page, content))
         
         if page == total_pages:
             output_string.append(f'"\n')
@@ -283,6 +339,162 @@ def build_output_string_withoutsection(output):
     output_string.append(f'}}')
     return ''.join(output_string)
 
+#Build the output string of a single page (without the closing quote)
+def build_page_string_withoutsection(page, content):
+    output_string = []
+    output_string.append(f'"Page {page}":"\n')
+    # Add the text content for the page
+    if content.get('text'):
+        content_text = [text.replace('\\','/').replace('"', '\\"') for text in content['text']]
+        output_string.append(f"  Text: {', '.join(content_text)}\n")
+    else:
+        content_text = f"This page {page} is blank"  
+        output_string.append(f"  Text: {content_text}\n")
+    
+    # Add the key-value pairs for the page
+    if content.get('KeyValuePairs'):
+        output_string.append(f"  Key-Value Pairs:\n")
+        for kvp in content['KeyValuePairs']:
+            for key, value in kvp.items():
+                content_key = key.replace('\\','/').replace('"','\\"')
+                content_value = value.replace('\\','/').replace('"','\\"')
+                output_string.append(f"    {content_key}: {content_value}\n")
+    
+    # Add the tables for the page
+    if content.get('tables'):
+        output_string.append(f"  Tables:\n")
+        for table_index, table_data in enumerate(content['tables'], start=1):
+            output_string.append(f"    Table {table_index}:\n")
+            column_header = ', '.join(table_data['Column Header']).replace('\\','/').replace('"', '\\"')
+            output_string.append(f"      Column Header: {column_header}\n")
+            for row_index, row in enumerate(table_data['Rows'], start=1):
+                row_v = ', '.join(row).replace('\\','/').replace('"', '\\"')
+                output_string.append(f"      Row{row_index}: {row_v}\n")
+    return ''.join(output_string)
+
+#Build the structured output as real JSON: {"1": {"text_lines": [...], "kv": [...], "tables": [...]}, ...}
+def build_output_json_withoutsection(output):
+    pages = [build_page_json_withoutsection(page, content) for page, content in output.items()]
+    return '{' + ',\n'.join(pages) + '\n}' if pages else '{}'
+
+#Build the JSON member ("page": {...}) of a single page
+def build_page_json_withoutsection(page, content):
+    page_json = {
+        'text_lines': content.get('text', []),
+        'kv': [{'key': key.strip(), 'value': value.strip()} for kvp in content.get('KeyValuePairs', []) for key, value in kvp.items()],
+        'tables': [{'column_header': table['Column Header'], 'rows': table['Rows']} for table in content.get('tables', [])]
+    }
+    return f'{json.dumps(str(page))}: {json.dumps(page_json, ensure_ascii=False)}'
+
+#Yield the items of one top-level array (e.g. "Blocks") of a JSON object read in byte chunks,
+#holding only the current item and the unread part of the current chunk in memory
+def iter_json_array_items(chunks, array_key='Blocks'):
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, pos, eof = '', 0, False
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        if eof:
+            return False
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buffer = buffer[pos:] + (utf8.decode(b'', final=True) if eof else utf8.decode(chunk))
+        pos = 0
+        return True
+
+    def next_char():
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not read_more() or (eof and pos >= len(buffer)):
+                raise ValueError('Unexpected end of Textract JSON')
+
+    def decode_value():
+        nonlocal pos
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if not read_more():
+                    raise
+                continue
+            # A number ending exactly at the buffer end may continue in the next chunk
+            if end == len(buffer) and not eof and read_more():
+                continue
+            pos = end
+            return value
+
+    if next_char() != '{':
+        raise ValueError('Textract JSON is not an object')
+    pos += 1
+    while True:
+        char = next_char()
+        if char == '}':
+            return
+        if char == ',':
+            pos += 1
+            continue
+        key = decode_value()
+        if next_char() != ':':
+            raise ValueError('Malformed Textract JSON')
+        pos += 1
+        if key != array_key:
+            decode_value()
+            continue
+        if next_char() != '[':
+            raise ValueError(f'"{array_key}" is not an array')
+        pos += 1
+        while True:
+            char = next_char()
+            if char == ']':
+                pos += 1
+                break
+            if char == ',':
+                pos += 1
+                continue
+            yield decode_value()
+
+#Stream the merged Textract json into the structured text file, page by page
+#Same output as extract_text_from_textract_withoutsection + build_output_string_withoutsection
+#(or build_output_json_withoutsection when output_format is "json")
+def stream_structured_output(bucket_name, input_key, output_key, output_format='text'):
+    response = s3.get_object(Bucket=bucket_name, Key=input_key)
+    blocks = iter_json_array_items(response['Body'].iter_chunks(chunk_size=1024 * 1024), 'Blocks')
+
+    writer = S3MultipartWriter(s3, bucket_name, output_key)
+    page_number = 0
+    pages_written = 0
+    try:
+        writer.write('{')
+        for page, page_blocks, block_by_id in iter_textract_pages(blocks):
+            page_content, _ = extract_text_from_textract_withoutsection({'Blocks': page_blocks}, block_by_id)
+            if output_format == 'json':
+                if pages_written:
+                    writer.write(',\n')
+                writer.write(build_page_json_withoutsection(page, page_content[page]))
+            else:
+                if pages_written:
+                    writer.write('",\n')
+                writer.write(build_page_string_withoutsection(page, page_content[page]))
+            pages_written += 1
+            page_number = page_blocks[-1].get('Page', 1)
+        if pages_written:
+            writer.write('\n' if output_format == 'json' else '"\n')
+        writer.write('}')
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    print(f"Streamed {pages_written} pages into {output_key}")
+    return page_number
+
 #Create and Update data in a log file in S3 
 def create_update_log_file(bucket_name,object_key, page_number,ocr_configpath):
     #S3 bucket and file details
@@ -317,6 +529,11 @@ def create_update_log_file(bucket_name,object_key, page_number,ocr_configpath):
     }
     
     
+    # Append-only when "ocr_processlog_format" is "ndjson": one small NDJSON object per event, partitioned by date/hour
+    if cached_config.get('ocr_processlog_format', 'json-array') == 'ndjson':
+        append_log_event(bucket_name, body, cached_config)
+        return "success"
+
     #Check if object exists already then update it or create new object 
     object_exists = check_if_object_exists(bucket_name,new_object_key)
     if object_exists:
@@ -329,6 +546,14 @@ def create_update_log_file(bucket_name,object_key, page_number,ocr_configpath):
     s3_put_object(bucket_name,new_object_key,json.dumps(log_data),'')
     return "success"
 
+#Write one log event as its own NDJSON object under a date/hour partition (no read-modify-write)
+def append_log_event(bucket_name, body, config):
+    events_prefix = config.get('ocr_processlog_events_prefix', 'logs/events/')
+    now = datetime.now()
+    event_key = f"{events_prefix}dt={now.strftime('%Y-%m-%d')}/hr={now.strftime('%H')}/{now.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:12]}.ndjson"
+    s3.put_object(Bucket=bucket_name, Key=event_key, Body=json.dumps(body) + '\n', ContentType='application/x-ndjson')
+    return event_key
+
 def check_if_object_exists(bucket, key):
     try:
         # Try to get metadata about the object
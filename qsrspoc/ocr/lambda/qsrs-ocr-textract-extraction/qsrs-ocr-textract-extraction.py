@@ -2,11 +2,14 @@ import json
 import urllib.parse
 import time
 import os
+import uuid
 import re
 import boto3
 import botocore
 from datetime import datetime
 from botocore.exceptions import ClientError
+from textract_results import (S3MultipartWriter, TextractJobScheduler, backoff_settings, iter_textract_results,
+                              new_fetch_stats, stream_textract_blocks)
 # Initialize boto3 clients for Textract,SNS, batch and S3
 textract = boto3.client('textract')
 s3 = boto3.client('s3')
@@ -20,50 +23,57 @@ def lambda_handler(event, context):
         global cached_config
         # Loop through each record (message) in the SQS event
         for record in event['Records']:
-            # Parse the message body and extract the job ID
-            message_body = json.loads(record['body'])
+            job_id = None
+            try:
+                # Parse the message body and extract the job ID
+                message_body = json.loads(record['body'])
             
-            #Load textract message and load as json to extract JobId and Status
-            textract_message = json.loads(message_body['Message'])
-            job_id = textract_message['JobId']
-            status = textract_message['Status']
-            print(f"job_id: {job_id}, status: {status} ")
-            #Initialize the variables and assign the values
-            s3init_ObjectName = textract_message['DocumentLocation']['S3ObjectName']
-            output_bucket = textract_message['DocumentLocation']['S3Bucket']
+                #Load textract message and load as json to extract JobId and Status
+                textract_message = json.loads(message_body['Message'])
+                job_id = textract_message['JobId']
+                status = textract_message['Status']
+                print(f"job_id: {job_id}, status: {status} ")
+                #Initialize the variables and assign the values
+                s3init_ObjectName = textract_message['DocumentLocation']['S3ObjectName']
+                output_bucket = textract_message['DocumentLocation']['S3Bucket']
             
-            # Split at the last '/' to separate the folder path and filename
-            foldername, filename = s3init_ObjectName.split('/', 1)
-            filename_without_extension = os.path.splitext(os.path.basename(filename))[0]
-            foldername, filename = filename.split('/') 
+                # Split at the last '/' to separate the folder path and filename
+                foldername, filename = s3init_ObjectName.split('/', 1)
+                filename_without_extension = os.path.splitext(os.path.basename(filename))[0]
+                foldername, filename = filename.split('/') 
             
-            #Get Global variables and Environment variable values 
-            ocr_configpath = os.getenv('ocr_configpath')
-            cached_config = s3_get_object_Json(output_bucket,ocr_configpath)
-            ocrresults_file_suffix = cached_config.get('ocr_results_suffix')
-            outputfilename = (f"{filename_without_extension}{ocrresults_file_suffix}")
-            ocr_pdf_split_results_folder = cached_config.get('ocr_pdf_split_results_folder')
-            ocrresults_folder = cached_config.get('ocr_resultsfolder')
-            savecleanpdfs3_featureflag = cached_config.get('savecleanpdfs3')
-            output_key = f'{ocr_pdf_split_results_folder}{foldername}/{outputfilename}.json'
+                #Get Global variables and Environment variable values 
+                ocr_configpath = os.getenv('ocr_configpath')
+                cached_config = s3_get_object_Json(output_bucket,ocr_configpath)
+                ocrresults_file_suffix = cached_config.get('ocr_results_suffix')
+                outputfilename = (f"{filename_without_extension}{ocrresults_file_suffix}")
+                ocr_pdf_split_results_folder = cached_config.get('ocr_pdf_split_results_folder')
+                ocrresults_folder = cached_config.get('ocr_resultsfolder')
+                savecleanpdfs3_featureflag = cached_config.get('savecleanpdfs3')
+                output_key = f'{ocr_pdf_split_results_folder}{foldername}/{outputfilename}.json'
             
-            # Check if the job completed successfully and store Json file in S3
-            if status == "SUCCEEDED":
+                # Check if the job completed successfully and store Json file in S3
+                if status == "SUCCEEDED":
                 
-                # Call Textract to get the job results
-                all_results = get_all_results(job_id)
-                #Merge all the results in one Json file
-                result_json = merge_results(all_results)
-                
-                #Add Job_id into metadata of the json file that will be stored in S3
-                metadata = {'AWS Textract jobid': f'{job_id}'}
+                    #Add Job_id into metadata of the json file that will be stored in S3
+                    metadata = {'AWS Textract jobid': f'{job_id}'}
                
-                # Upload the AWS Textract json output results to S3 
-                s3_put_object(output_bucket,output_key,result_json,metadata)
-                print(f"output_bucket: {output_bucket}, output_key: {output_key},, metadata: {metadata}")
+                    # Stream the AWS Textract json output results page by page into S3
+                    fetch_stats = stream_textract_results(job_id, output_bucket, output_key, metadata)
+                    print(f"output_bucket: {output_bucket}, output_key: {output_key},, metadata: {metadata}")
+                    print(f"Textract results fetched: {fetch_stats}")
                 
-            else:
-                print(f"Textract job {job_id} did not succeed. Status: {status}")
+                else:
+                    print(f"Textract job {job_id} did not succeed. Status: {status}")
+            finally:
+                # The job no longer counts against the Textract quota, whether or not its results were saved:
+                # free its slot and start queued splits, so a failed record cannot hold a slot forever
+                if job_id is not None and cached_config is not None:
+                    scheduler = get_textract_scheduler()
+                    if scheduler is not None:
+                        scheduler.release_slot(job_id)
+                        started = scheduler.drain(start_queued_job)
+                        print(f"Textract scheduler started {started} queued job(s)")
                 
         return {
             'statusCode': 200,
@@ -78,40 +88,51 @@ def lambda_handler(event, context):
         }
 
 
-#Get all the results from AWS Textract output from multiple json responses
-def get_all_results(job_id):
-    all_results = []
-    max_retries = 1
-    retries = 0
-    while retries < max_retries:
-        try:
-            response = textract.get_document_text_detection(JobId=job_id)
-            # Exit loop if successful
-            break
-        except botocore.exceptions.ClientError as error: 
-            error_code = error.response['Error']['Code']
-            #Retries in case of Throttling errors
-            if error_code == 'ProvisionedThroughputExceededException':
-                wait_time = (2 ** retries) + random.uniform(0, 1)
-                print(f"Throttled. Retrying in {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-                retries += 1
-            else:
-                # If it's a different error, re-raise it
-                raise
-    
-    all_results.extend(response['Blocks'])
+_textract_scheduler = None
 
-    while 'NextToken' in response:
-        next_token = response['NextToken']
-        response = textract.get_document_text_detection(JobId=job_id, NextToken=next_token)
-        all_results.extend(response['Blocks'])
-    
-    return all_results
+#Scheduler selected by config "ocr_textract_scheduler": "dynamodb", or "none" when splits are started right away
+def get_textract_scheduler():
+    global _textract_scheduler
+    if cached_config.get('ocr_textract_scheduler', 'none') == 'none':
+        return None
+    if _textract_scheduler is None:
+        _textract_scheduler = TextractJobScheduler(
+            boto3.client('dynamodb'),
+            cached_config.get('ocr_split_tracker_table'),
+            int(cached_config.get('ocr_textract_max_concurrent_jobs', '100'))
+        )
+    return _textract_scheduler
 
-#Merge all the json responses from AWS Textract
-def merge_results(all_results):
-    return json.dumps({'Blocks': all_results})
+#Start the text detection job of a queued split, notifying the same SNS topic as the uploader
+def start_queued_job(bucket_name, object_key, sns_topic_arn, role_arn):
+    return textract.start_document_text_detection(
+        DocumentLocation={
+            'S3Object': {
+                'Bucket': bucket_name,
+                'Name': object_key
+            }
+        },
+        NotificationChannel={
+            'SNSTopicArn': sns_topic_arn or os.getenv('snstopicarn'),
+            'RoleArn': role_arn or os.getenv('rolearn')
+        },
+    )
+
+#Stream the results of a text detection job into S3 as {"Blocks": [...]}, one results page in memory at a time
+#The file is byte for byte what json.dumps({'Blocks': all_blocks}) produced
+def stream_textract_results(job_id, bucket_name, file_key, metadata):
+    stats = new_fetch_stats()
+    writer = S3MultipartWriter(s3, bucket_name, file_key, metadata)
+    try:
+        responses = iter_textract_results(textract.get_document_text_detection, job_id, stats, **backoff_settings(cached_config))
+        for _ in stream_textract_blocks(responses, writer, stats):
+            pass
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    stats['throttle_wait_seconds'] = round(stats['throttle_wait_seconds'], 3)
+    return stats
 
 #Function to insert into s3 bucket
 def s3_put_object(bucket_name,file_key,body,metadata):
@@ -187,6 +208,11 @@ def create_update_log_file(bucket_name,object_key, page_number):
         "message": logfile_status_message
     }
     
+    # Append-only when "ocr_processlog_format" is "ndjson": one small NDJSON object per event, partitioned by date/hour
+    if cached_config.get('ocr_processlog_format', 'json-array') == 'ndjson':
+        append_log_event(bucket_name, body, cached_config)
+        return "success"
+
     #Check if object exists already then update it or create new object 
     object_exists = check_if_object_exists(bucket_name,new_object_key)
     if object_exists:
@@ -199,6 +225,14 @@ def create_update_log_file(bucket_name,object_key, page_number):
     s3_put_object(bucket_name,new_object_key,json.dumps(log_data),'')
     return "success"
 
+#Write one log event as its own NDJSON object under a date/hour partition (no read-modify-write)
+def append_log_event(bucket_name, body, config):
+    events_prefix = config.get('ocr_processlog_events_prefix', 'logs/events/')
+    now = datetime.now()
+    event_key = f"{events_prefix}dt={now.strftime('%Y-%m-%d')}/hr={now.strftime('%H')}/{now.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:12]}.ndjson"
+    s3.put_object(Bucket=bucket_name, Key=event_key, Body=json.dumps(body) + '\n', ContentType='application/x-ndjson')
+    return event_key
+
 #Check to see if object already exists in S3 
 def check_if_object_exists(bucket, key):
     try:
@@ -1,18 +1,25 @@
 import json
 import urllib.parse
 import os
+import uuid
+import time
+import random
+import threading
+import math
 import boto3
 import fitz  # PyMuPDF
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from botocore.exceptions import ClientError
+from textract_results import TextractJobScheduler
 s3 = boto3.client('s3')
+# One Textract client for the life of the container, shared by the upload threads
+textract = boto3.client('textract')
 
 cached_config = None
 
 def lambda_handler(event, context):
-    # Initialize S3 and Textract clients
     global cached_config
-    textract = boto3.client('textract')
     
     
     # Extract bucket name and object key from the S3 event
@@ -82,6 +89,11 @@ def create_update_log_file(bucket_name,object_key):
         "message": logfile_status_message
     }
     
+    # Append-only when "ocr_processlog_format" is "ndjson": one small NDJSON object per event, partitioned by date/hour
+    if cached_config.get('ocr_processlog_format', 'json-array') == 'ndjson':
+        append_log_event(bucket_name, body, cached_config)
+        return "success"
+
     #Check if object exists already then update it or create new object 
     object_exists = check_if_object_exists(bucket_name,new_object_key)
     if object_exists:
@@ -94,33 +106,141 @@ def create_update_log_file(bucket_name,object_key):
     s3_put_object(bucket_name,new_object_key,json.dumps(log_data),'')
     return "success"
 
+#Write one log event as its own NDJSON object under a date/hour partition (no read-modify-write)
+def append_log_event(bucket_name, body, config):
+    events_prefix = config.get('ocr_processlog_events_prefix', 'logs/events/')
+    now = datetime.now()
+    event_key = f"{events_prefix}dt={now.strftime('%Y-%m-%d')}/hr={now.strftime('%H')}/{now.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:12]}.ndjson"
+    s3.put_object(Bucket=bucket_name, Key=event_key, Body=json.dumps(body) + '\n', ContentType='application/x-ndjson')
+    return event_key
+
 # This method uses to split pdf, upload to s3 and call process_pdf function to initiate OCR process by calling AWS Textract
+# Pipelined: PyMuPDF splits on this thread (one page-range insert per chunk, kept in memory) while a
+# thread pool uploads finished chunks and submits their Textract jobs through a rate limiter
 def split_and_upload_pdf(file_path, bucket_name, original_key, pdf_split_size, ocr_pdf_preprocess_s3folder):
     pdf_document = fitz.open(file_path)
     num_pages = pdf_document.page_count
     print(f"file_path: {file_path}, bucket name: {bucket_name}, original_key: {original_key}, pdf_split_size: {pdf_split_size}, ocr_pdf_preprocess: {ocr_pdf_preprocess_s3folder}")
     
-    # Split in chunks of configurable number of pages from config.json
-    chunk_size = pdf_split_size  # Adjust based on testing
+    # Split in chunks of configurable number of pages from config.json, or sized from the page count
+    # and the Textract job slots still free when the adaptive planner is on
+    scheduler = get_textract_scheduler()
+    if cached_config.get('ocr_pdf_split_adaptive', '0') == '1':
+        in_flight = scheduler.in_flight() if scheduler is not None else 0
+        chunk_size = plan_split_size(num_pages, in_flight, cached_config)
+    else:
+        chunk_size = pdf_split_size  # Adjust based on testing
     total_splits = (num_pages + chunk_size - 1) // chunk_size  # Total chunks
-    for i in range(0, num_pages, chunk_size):
-        new_pdf = fitz.open()
-        for j in range(i, min(i + chunk_size, num_pages)):
-            new_pdf.insert_pdf(pdf_document, from_page=j, to_page=j)
+    # Identifies this split of the document, so the merge tracks a re-upload or re-split separately
+    split_run = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    print(f"num_pages: {num_pages}, chunk_size: {chunk_size}, total_splits: {total_splits}, split_run: {split_run}")
+    concurrency = int(cached_config.get('ocr_split_upload_concurrency', '8'))
+    submitter = get_textract_submitter()
 
-        chunk_filename = f"/tmp/{os.path.basename(original_key)}_part_{i//chunk_size+1}.pdf"
-        new_pdf.save(chunk_filename)
+    # Caps the chunks held in memory while waiting for an upload slot
+    pending_chunks = threading.BoundedSemaphore(concurrency * 2)
 
-        s3_key = f"{ocr_pdf_preprocess_s3folder}{os.path.basename(original_key)}/{os.path.basename(original_key)}_part_{i//chunk_size+1}.pdf"
-        s3.upload_file(chunk_filename, bucket_name, s3_key, ExtraArgs={"Metadata": {"total_p": str(total_splits)}})
-        
-        # Trigger Textract for each split file 
-        process_pdf(bucket_name, s3_key)
-        print(f"Textract Job started successfully for {s3_key}")
+    def upload_and_submit(chunk_bytes, s3_key):
+        try:
+            s3.put_object(Bucket=bucket_name, Key=s3_key, Body=chunk_bytes, Metadata={"total_p": str(total_splits), "split_run": split_run})
+            # Trigger Textract for each split file, or queue it until a job slot frees up
+            if scheduler is None or scheduler.acquire_slot():
+                try:
+                    submitter.submit(bucket_name, s3_key)
+                except Exception:
+                    if scheduler is not None:
+                        scheduler.release_slot()
+                    raise
+                print(f"Textract Job started successfully for {s3_key}")
+            else:
+                scheduler.enqueue(bucket_name, s3_key, os.getenv('snstopicarn'), os.getenv('rolearn'))
+                print(f"Textract Job queued for {s3_key}")
+        finally:
+            pending_chunks.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = []
+        for i in range(0, num_pages, chunk_size):
+            new_pdf = fitz.open()
+            new_pdf.insert_pdf(pdf_document, from_page=i, to_page=min(i + chunk_size, num_pages) - 1)
+            chunk_bytes = new_pdf.tobytes()
+            new_pdf.close()
+
+            s3_key = f"{ocr_pdf_preprocess_s3folder}{os.path.basename(original_key)}/{os.path.basename(original_key)}_part_{i//chunk_size+1}.pdf"
+            pending_chunks.acquire()
+            futures.append(pool.submit(upload_and_submit, chunk_bytes, s3_key))
+
+        # Surface the first failure, after every chunk has been attempted
+        for future in futures:
+            future.result()
+
+#Token bucket shared by all threads: at most `tps` StartDocumentTextDetection calls per second
+class TextractSubmitter:
+    THROTTLING_ERROR_CODES = ('ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException')
+
+    def __init__(self, tps, max_retries=6):
+        self.interval = 1.0 / tps
+        self.max_retries = max_retries
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_for_slot(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def submit(self, bucket_name, object_key):
+        for attempt in range(self.max_retries + 1):
+            self.wait_for_slot()
+            try:
+                return process_pdf(bucket_name, object_key)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in self.THROTTLING_ERROR_CODES or attempt == self.max_retries:
+                    raise
+                # Throttled despite the limiter (other uploads share the quota): back off with jitter
+                time.sleep(random.uniform(0, min(20, 0.5 * 2 ** attempt)))
+
+_textract_submitter = None
+
+#Pick pages per split: spread a record over the job slots still free (lowest latency), never below
+#ocr_pdf_split_size pages (small records stay in one job) nor above ocr_pdf_split_max_size pages
+def plan_split_size(num_pages, in_flight, config):
+    min_split = int(config.get('ocr_pdf_split_size', '10'))
+    max_split = int(config.get('ocr_pdf_split_max_size', '300'))
+    quota = int(config.get('ocr_textract_max_concurrent_jobs', '100'))
+    # Leave some slots for other records arriving at the same time
+    reserve = int(config.get('ocr_textract_reserved_jobs', '0'))
+    free_slots = max(1, quota - reserve - in_flight)
+    split_size = math.ceil(num_pages / free_slots)
+    return max(1, min(max_split, max(min_split, split_size)))
+
+_textract_scheduler = None
+
+#Scheduler selected by config "ocr_textract_scheduler": "dynamodb", or "none" to start every split right away
+def get_textract_scheduler():
+    global _textract_scheduler
+    if cached_config.get('ocr_textract_scheduler', 'none') == 'none':
+        return None
+    if _textract_scheduler is None:
+        _textract_scheduler = TextractJobScheduler(
+            boto3.client('dynamodb'),
+            cached_config.get('ocr_split_tracker_table'),
+            int(cached_config.get('ocr_textract_max_concurrent_jobs', '100'))
+        )
+    return _textract_scheduler
+
+#Submitter sized by config "ocr_textract_start_tps" (the account's StartDocumentTextDetection quota)
+def get_textract_submitter():
+    global _textract_submitter
+    if _textract_submitter is None:
+        _textract_submitter = TextractSubmitter(float(cached_config.get('ocr_textract_start_tps', '5')))
+    return _textract_submitter
 
 #Initiate async OCR process for a pdf after split and send notification once completed 
 def process_pdf(bucket_name, object_key):
-    textract = boto3.client('textract')
     env_snstopicarn = os.getenv('snstopicarn')
     env_rolearn = os.getenv('rolearn')
     featuretypes = json.loads(cached_config.get('ocr_featuretypes'))  # Convert string to list
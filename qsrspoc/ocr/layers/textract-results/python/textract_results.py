@@ -0,0 +1,297 @@
+import json
+import time
+import uuid
+import random
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+# Shared by the OCR Lambdas (through the textract-results layer) and the AWS Batch job:
+# fetching Textract results with backoff, streaming them to S3, grouping blocks into pages,
+# and scheduling Textract jobs against the account quota
+
+# Textract error codes worth retrying: throttling, plus the transient server side errors
+TEXTRACT_RETRY_ERROR_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException',
+                              'LimitExceededException', 'InternalServerError')
+
+#Backoff settings from the OCR config: "ocr_textract_get_max_retries" and "ocr_textract_get_base_delay"
+def backoff_settings(config):
+    return {
+        'max_retries': int(config.get('ocr_textract_get_max_retries', '8')),
+        'base_delay': float(config.get('ocr_textract_get_base_delay', '0.5'))
+    }
+
+def new_fetch_stats():
+    return {'pages': 0, 'retries': 0, 'throttle_wait_seconds': 0.0}
+
+#Call one page of Textract results, retrying with full jitter exponential backoff
+#stats collects the pages fetched, the retries and the seconds spent waiting on throttling
+def get_textract_page_with_backoff(get_results, stats, max_retries=8, base_delay=0.5, **kwargs):
+    retries = 0
+    while True:
+        try:
+            response = get_results(**kwargs)
+            stats['pages'] += 1
+            return response
+        except ClientError as error:
+            error_code = error.response['Error']['Code']
+            if error_code not in TEXTRACT_RETRY_ERROR_CODES or retries >= max_retries:
+                raise
+            wait_time = random.uniform(0, base_delay * (2 ** retries))
+            print(f"{error_code} on Textract results page {stats['pages'] + 1}. Retrying in {wait_time:.2f} seconds...")
+            time.sleep(wait_time)
+            retries += 1
+            stats['retries'] += 1
+            stats['throttle_wait_seconds'] += wait_time
+
+#Yield each page (response) of a Textract job's results, following NextToken with backoff on every call
+def iter_textract_results(get_results, job_id, stats=None, max_retries=8, base_delay=0.5):
+    stats = stats if stats is not None else new_fetch_stats()
+    response = get_textract_page_with_backoff(get_results, stats, max_retries, base_delay, JobId=job_id)
+    yield response
+    while 'NextToken' in response:
+        response = get_textract_page_with_backoff(get_results, stats, max_retries, base_delay,
+                                                  JobId=job_id, NextToken=response['NextToken'])
+        yield response
+
+#Write the blocks of the responses to writer as {"Blocks": [...]}, yielding each block once it is written
+#The file is byte for byte what json.dumps({'Blocks': all_blocks}) produced; stats['blocks'] counts them
+def stream_textract_blocks(responses, writer, stats):
+    stats.setdefault('blocks', 0)
+    writer.write('{"Blocks": [')
+    for response in responses:
+        if not response['Blocks']:
+            continue
+        writer.write((', ' if stats['blocks'] else '') + ', '.join(json.dumps(block) for block in response['Blocks']))
+        stats['blocks'] += len(response['Blocks'])
+        yield from response['Blocks']
+    writer.write(']}')
+
+#Upload text written piece by piece as one S3 object, holding at most one part in memory
+class S3MultipartWriter:
+    PART_SIZE = 8 * 1024 * 1024  # S3 parts must be >= 5 MB, except the last one
+
+    def __init__(self, s3_client, bucket_name, file_key, metadata=None):
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.extra_args = {'Metadata': metadata} if metadata else {}
+        self.upload_id = None
+        self.parts = []
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.PART_SIZE:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, **self.extra_args)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3.upload_part(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=b''.join(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer, self.buffer_size = [], 0
+
+    def close(self):
+        if self.upload_id is None:
+            # Small output: a single put, as before
+            self.s3.put_object(Bucket=self.bucket_name, Key=self.file_key, Body=b''.join(self.buffer), **self.extra_args)
+            return
+        if self.buffer:
+            self._upload_part()
+        self.s3.complete_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3.abort_multipart_upload(Bucket=self.bucket_name, Key=self.file_key, UploadId=self.upload_id)
+
+#Group a stream of Textract blocks into pages. A page is yielded once a later page has started and
+#every block it references has arrived; only unfinished pages are kept in memory
+def iter_textract_pages(blocks):
+    block_by_id = {}
+    pending = OrderedDict()  # page number -> blocks, in first-seen order
+    unresolved = {}  # page number -> referenced ids not seen yet
+    current_page = None
+
+    def is_complete(page):
+        unresolved[page] = {block_id for block_id in unresolved[page] if block_id not in block_by_id}
+        return not unresolved[page]
+
+    def pop_page(page):
+        page_blocks = pending.pop(page)
+        unresolved.pop(page)
+        page_block_by_id = {block['Id']: block_by_id.pop(block['Id']) for block in page_blocks}
+        # Forward references into other pending pages are resolved from the shared map
+        for block in page_blocks:
+            for rel in block.get('Relationships', []):
+                for block_id in rel.get('Ids', []):
+                    if block_id not in page_block_by_id and block_id in block_by_id:
+                        page_block_by_id[block_id] = block_by_id[block_id]
+        return page, page_blocks, page_block_by_id
+
+    for block in blocks:
+        page = block.get('Page', 1)
+        if page != current_page:
+            current_page = page
+            while pending and next(iter(pending)) != current_page and is_complete(next(iter(pending))):
+                yield pop_page(next(iter(pending)))
+
+        pending.setdefault(page, []).append(block)
+        unresolved.setdefault(page, set())
+        block_by_id[block['Id']] = block
+        for rel in block.get('Relationships', []):
+            unresolved[page].update(rel.get('Ids', []))
+
+    while pending:
+        yield pop_page(next(iter(pending)))
+
+#Account-wide count of running Textract jobs, plus a FIFO of split files waiting for a slot. Items live in the
+#split tracker table under pk "textract-scheduler": the uploader takes slots and queues splits, the extraction
+#Lambda frees a slot per finished job and starts queued splits
+class TextractJobScheduler:
+    PK = 'textract-scheduler'
+    # Keep the per-job release markers for a day, long enough to absorb SQS redeliveries
+    RELEASE_MARKER_TTL = 86400
+
+    def __init__(self, dynamodb_client, table_name, max_jobs):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+        self.max_jobs = max_jobs
+
+    def _slots_key(self):
+        return {'pk': {'S': self.PK}, 'sk': {'S': 'slots'}}
+
+    def _release_marker(self, job_id):
+        return {
+            'pk': {'S': self.PK},
+            'sk': {'S': f"released#{job_id}"},
+            'expires_at': {'N': str(int(time.time()) + self.RELEASE_MARKER_TTL)}
+        }
+
+    def _decrement(self):
+        return {
+            'TableName': self.table_name,
+            'Key': self._slots_key(),
+            'UpdateExpression': 'ADD in_flight :minus_one',
+            'ConditionExpression': 'in_flight > :zero',
+            'ExpressionAttributeValues': {':minus_one': {'N': '-1'}, ':zero': {'N': '0'}}
+        }
+
+    def in_flight(self):
+        item = self.dynamodb.get_item(TableName=self.table_name, Key=self._slots_key(), ConsistentRead=True).get('Item', {})
+        return int(item.get('in_flight', {'N': '0'})['N'])
+
+    def acquire_slot(self):
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._slots_key(),
+                UpdateExpression='ADD in_flight :one',
+                ConditionExpression='attribute_not_exists(in_flight) OR in_flight < :max_jobs',
+                ExpressionAttributeValues={':one': {'N': '1'}, ':max_jobs': {'N': str(self.max_jobs)}}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def release_slot(self, job_id=None):
+        if job_id is None:
+            # A slot taken for a job that never started: nothing can deliver it twice
+            try:
+                self.dynamodb.update_item(**self._decrement())
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            return
+        # With a job id, the marker and the decrement are written together, so the slot is released
+        # exactly once per job even if the completion message is delivered twice or the Lambda dies midway
+        try:
+            self.dynamodb.transact_write_items(TransactItems=[
+                {'Put': {'TableName': self.table_name, 'Item': self._release_marker(job_id),
+                         'ConditionExpression': 'attribute_not_exists(sk)'}},
+                {'Update': self._decrement()}
+            ])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if reasons[:1] == ['ConditionalCheckFailed']:
+                print(f"Slot for Textract job {job_id} already released")
+                return
+            if reasons[1:2] != ['ConditionalCheckFailed']:
+                raise
+            # The counter is already at zero: record the job as released so a redelivery does not decrement later
+            try:
+                self.dynamodb.put_item(TableName=self.table_name, Item=self._release_marker(job_id),
+                                       ConditionExpression='attribute_not_exists(sk)')
+            except ClientError as put_error:
+                if put_error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+
+    def enqueue(self, bucket_name, object_key, sns_topic_arn, role_arn):
+        # Sort key starts with the enqueue time, so a query returns the oldest job first
+        self.dynamodb.put_item(
+            TableName=self.table_name,
+            Item={
+                'pk': {'S': self.PK},
+                'sk': {'S': f"queue#{time.time_ns():020d}#{uuid.uuid4().hex[:8]}"},
+                'bucket': {'S': bucket_name},
+                'object_key': {'S': object_key},
+                'sns_topic_arn': {'S': sns_topic_arn or ''},
+                'role_arn': {'S': role_arn or ''}
+            }
+        )
+
+    def _oldest_queued(self):
+        response = self.dynamodb.query(
+            TableName=self.table_name,
+            KeyConditionExpression='pk = :pk AND begins_with(sk, :queue)',
+            ExpressionAttributeValues={':pk': {'S': self.PK}, ':queue': {'S': 'queue#'}},
+            ConsistentRead=True,
+            Limit=1
+        )
+        items = response.get('Items', [])
+        return items[0] if items else None
+
+    def _claim(self, item):
+        # Only one drainer may take a queued item
+        try:
+            self.dynamodb.delete_item(
+                TableName=self.table_name,
+                Key={'pk': item['pk'], 'sk': item['sk']},
+                ConditionExpression='attribute_exists(sk)'
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    #Start queued splits, oldest first, while slots are free; returns the number of jobs started
+    #start_job(bucket_name, object_key, sns_topic_arn, role_arn) starts the Textract job of one split
+    def drain(self, start_job):
+        started = 0
+        while True:
+            item = self._oldest_queued()
+            if item is None or not self.acquire_slot():
+                return started
+            if not self._claim(item):
+                self.release_slot()
+                continue
+            try:
+                start_job(item['bucket']['S'], item['object_key']['S'], item['sns_topic_arn']['S'], item['role_arn']['S'])
+            except Exception as e:
+                # Put the split back at the head of the queue for the next completion to retry
+                print(f"Error starting queued Textract job for {item['object_key']['S']}: {e}")
+                self.dynamodb.put_item(TableName=self.table_name, Item=item)
+                self.release_slot()
+                return started
+            print(f"Queued Textract job started for {item['object_key']['S']}")
+            started += 1
@@ -150,6 +150,39 @@ resource "aws_s3_bucket_object" "folder10" {
   key    = "config/ai-ml/"  
 }
 
+##################################################################
+#    DYNAMODB: OCR split tracker / Textract job scheduler
+##################################################################
+# Used by qsrs-ocr-results-merge-orchestrator (ocr_split_tracker = "dynamodb") and by the Textract
+# job scheduler of the upload / extraction Lambdas (ocr_textract_scheduler = "dynamodb")
+resource "aws_dynamodb_table" "ocr_split_tracker" {
+  name         = var.ocr_split_tracker_table
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "pk"
+  range_key    = "sk"
+
+  attribute {
+    name = "pk"
+    type = "S"
+  }
+
+  attribute {
+    name = "sk"
+    type = "S"
+  }
+
+  # Split-part, split-status and job-release items expire on their own
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+   Name        = var.ocr_split_tracker_table
+   Environment = "Dev"
+  }
+}
+
 ##################################################################
 #    SQS MODULE
 ##################################################################
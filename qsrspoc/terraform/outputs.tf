@@ -18,3 +18,7 @@ output "dlq_arns" {
     topic => mod.dlq_arns
   }
 }
+
+output "ocr_split_tracker_table" {
+  value = aws_dynamodb_table.ocr_split_tracker.name
+}
@@ -49,6 +49,12 @@ variable "versioning_bucket_name" {
   description = "The name of the versioning S3 bucket "
 }
 
+# DynamoDB
+variable "ocr_split_tracker_table" {
+  description = "The name of the DynamoDB table behind the OCR split tracker and Textract job scheduler (ocr_split_tracker_table in config/ocr/config.json)"
+  default = "qsrs-ocr-split-tracker"
+}
+
 # SQS
 variable sqs_queue_name {
   description = "The name of the SQS Queue"